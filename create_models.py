@@ -8,8 +8,15 @@ from sklearn import neural_network
 from joblib import dump, load
 from cbor2 import load as loadCbor
 from argparse import ArgumentParser
+from functools import partial
+import json
 import os
 from multiprocessing import Pool
+from features import predict_keys
+
+# Decoded training data, one row per cbor file: X.npy, y.npy and index.json, which maps every file (by path, size and
+# mtime) to its row, or to -1 if it could not be decoded. Files that did not change are not decoded again.
+CACHE_DIR = 'cache/training-data'
 
 models = {
     'SVR': svm.SVR(),
@@ -20,20 +27,6 @@ models = {
     'MLPR': neural_network.MLPRegressor(random_state=1),  # ? parameter tuning
 }
 
-predict_keys = [
-    'machineCount',
-    'jobCount',
-    'opCount',
-    'vertexDepth',
-    'avgOpTime',
-    'minOpTime',
-    'maxOpTime',
-    'idleTime',
-    'opsRemaining',
-    'alapST'
-]
-
-
 def print_stats(label, xs):
     print(label, 'std =', np.std(xs), 'mean =', np.mean(xs), 'min =', np.min(xs), 'max =', np.max(xs))
 
@@ -43,20 +36,19 @@ def main():
     cbor_dir = args.cbor_dir
 
     print("Loading training data")
-    x, y = get_training_data(cbor_dir, predict_keys, 'makespan')
+    x, y = get_training_data(cbor_dir, predict_keys, 'makespan', args.cache_dir, args.jobs)
 
     print("Stats")
-    xn = np.array(x)
     for i, key in enumerate(predict_keys):
-        chunk = xn[:, i]
+        chunk = x[:, i]
         print_stats(key, chunk)
     print_stats('makespan', y)
 
     print("Training")
-    train(x, y)
+    train(args.cache_dir, args.jobs)
 
     print("Predicting")
-    predict([x[0]])
+    predict(x[:1])
 
     print('gt', y[0])
 
@@ -64,45 +56,111 @@ def main():
 def parse_args():
     parser = ArgumentParser(description='Train models based on cbor files')
     parser.add_argument('cbor_dir', type=str, action='store', help='Directory containing cbor files')
+    parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='Directory to cache the decoded cbor files in')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of processes to use')
     return parser.parse_args()
 
 
-def get_training_data(cbor_dir, input_key_names, output_key_name):
+def decode_file(path, input_key_names, output_key_name):
+    """The inputs and output of one cbor file, None if it cannot be decoded"""
+    with open(path, 'rb') as fp:
+        try:
+            cbor_data = loadCbor(fp)
+        except:
+            return None
+
+    for key_name in input_key_names:
+        if key_name not in cbor_data:
+            raise Exception(f"input_key_name '{key_name}' not in cbor data")
+
+    if output_key_name not in cbor_data:
+        raise Exception(f"output_key_name '{output_key_name}' not in cbor data")
+
+    return [cbor_data[key] for key in input_key_names], cbor_data[output_key_name]
+
+
+def load_cache(cache_dir, input_key_names, output_key_name):
+    """The cached rows by path as (size, mtime, row), with the cached X and y"""
+    try:
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            index = json.load(f)
+        x = np.load(os.path.join(cache_dir, 'X.npy'))
+        y = np.load(os.path.join(cache_dir, 'y.npy'))
+    except (OSError, ValueError):
+        return {}, None, None
+    if index['inputKeys'] != input_key_names or index['outputKey'] != output_key_name:
+        return {}, None, None
+    return {path: (size, mtime, row) for path, size, mtime, row in index['files']}, x, y
+
+
+def save_cache(cache_dir, input_key_names, output_key_name, files, x, y):
+    os.makedirs(cache_dir, exist_ok=True)
+    for name, array in (('X', x), ('y', y)):
+        np.save(os.path.join(cache_dir, f'{name}.tmp.npy'), array)
+        os.replace(os.path.join(cache_dir, f'{name}.tmp.npy'), os.path.join(cache_dir, f'{name}.npy'))
+    # the index last, it only describes complete arrays
+    with open(os.path.join(cache_dir, 'index.tmp.json'), 'w') as f:
+        json.dump({'inputKeys': input_key_names, 'outputKey': output_key_name, 'files': files}, f)
+    os.replace(os.path.join(cache_dir, 'index.tmp.json'), os.path.join(cache_dir, 'index.json'))
+
+
+def get_training_data(cbor_dir, input_key_names, output_key_name, cache_dir=CACHE_DIR, jobs=None):
+    """
+    The inputs and outputs of all cbor files under cbor_dir (broken files are skipped), as a float64 matrix and vector.
+    Files that are new or changed since the last run are decoded in parallel, the others come from the cache.
+    """
     if not os.path.exists(cbor_dir):
         raise Exception(f"Invalid cbor dir {cbor_dir}")
 
-    x = []  # inputs
-    y = []  # outputs
+    paths = []
     for subdirs, dirs, files in os.walk(cbor_dir):
         for file in files:
             if file.endswith(".cbor"):
-                with open(os.path.join(subdirs, file), 'rb') as fp:
-                    try:
-                        cbor_data = loadCbor(fp)
-                    except:
-                        continue
-
-                for key_name in input_key_names:
-                    if key_name not in cbor_data:
-                        raise Exception(f"input_key_name '{key_name}' not in cbor data")
-
-                if output_key_name not in cbor_data:
-                    raise Exception(f"output_key_name '' not in cbor data")
-
-                cbor_values = [cbor_data[key] for key in input_key_names]
-                x.append(cbor_values)
-                y.append(cbor_data[output_key_name])
-
+                paths.append(os.path.abspath(os.path.join(subdirs, file)))
+
+    cached, cached_x, cached_y = load_cache(cache_dir, input_key_names, output_key_name)
+    stats = [os.stat(path) for path in paths]
+    todo = [path for path, stat in zip(paths, stats)
+            if cached.get(path, (None, None, None))[:2] != (stat.st_size, stat.st_mtime_ns)]
+    print(f"Decoding {len(todo)} of {len(paths)} cbor files")
+    decode = partial(decode_file, input_key_names=input_key_names, output_key_name=output_key_name)
+    # a few chunks per process: one small file per task would be mostly message passing
+    chunksize = max(1, len(todo) // (4 * (jobs or os.cpu_count())))
+    with Pool(processes=jobs) as pool:
+        decoded = dict(zip(todo, pool.map(decode, todo, chunksize=chunksize)))
+
+    x = np.empty((len(paths), len(input_key_names)))
+    y = np.empty(len(paths))
+    files = []
+    rows = 0
+    for path, stat in zip(paths, stats):
+        if path in decoded:
+            if decoded[path] is None:
+                files.append([path, stat.st_size, stat.st_mtime_ns, -1])
+                continue
+            x[rows], y[rows] = decoded[path]
+        else:
+            row = cached[path][2]
+            if row < 0:
+                files.append([path, stat.st_size, stat.st_mtime_ns, -1])
+                continue
+            x[rows], y[rows] = cached_x[row], cached_y[row]
+        files.append([path, stat.st_size, stat.st_mtime_ns, rows])
+        rows += 1
+    x, y = x[:rows], y[:rows]
+    save_cache(cache_dir, input_key_names, output_key_name, files, x, y)
     return x, y
 
 
-def train(x, y):
-    with Pool(processes=os.cpu_count()) as pool:
-        # TODO: it may be faster to load x, y in the train_model function (this is a lot of message passing)
-        pool.starmap(train_model, [(name, model, x, y) for name, model in models.items()])
+def train(cache_dir=CACHE_DIR, jobs=None):
+    with Pool(processes=jobs) as pool:
+        # the workers map the cached arrays instead of getting a pickled copy of the training data each
+        pool.starmap(train_model, [(name, model, cache_dir) for name, model in models.items()])
 
 
-def train_model(name, model, x, y):
+def train_model(name, model, cache_dir=CACHE_DIR):
+    x = np.load(os.path.join(cache_dir, 'X.npy'), mmap_mode='r')
+    y = np.load(os.path.join(cache_dir, 'y.npy'), mmap_mode='r')
     model.fit(x, y)
     dump(model, f'models/{name}.joblib')
     print(f"Done training {name}")
@@ -1,8 +1,18 @@
 from json.encoder import INFINITY
 import argparse
 import os.path
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
 from cbor2 import load
 
+CANON_SUBCLASS = "Canon2ReentrancyNormalDeadlinesNormalOrder"
+EXPLORATION_TYPES = {
+    "CPMIP": ["CP", "MIP"],
+    "SAG": ["depth", "breadth", "best", "static", "adaptive"],
+}
+SHOP_TYPES = ["FlowShops", "JobShops"]
+BENCHMARK_FOLDERS = ["DaColTeppanLargeBenchmarks", "DemirkolBenchmarks", "DemirkolBenchmarksDeadlinesAbsolute"]
+
 
 def createParser():
     parser = argparse.ArgumentParser(description='Analyse Results')
@@ -18,42 +28,55 @@ def createParser():
                         type=str,
                         action='store',
                         help='enter solve type of schedule')
+    parser.add_argument('--batch', '-b',
+                        type=str,
+                        action='store',
+                        help='Summarize all results of this input folder (with Instances/ and Results/) at once')
+    parser.add_argument('--outFolder', '-o',
+                        type=str,
+                        action='store',
+                        help='(batch) also write one file per result to this folder')
+    parser.add_argument('--summary', '-s',
+                        type=str,
+                        default="Summary.txt",
+                        action='store',
+                        help='(batch) the summary file to write')
+    parser.add_argument('--jobs', '-j',
+                        type=int,
+                        action='store',
+                        help='(batch) number of processes decoding the cbor files')
     return parser
 
 
-def run(args):
-    if (args.input.split(".")[-1] != "xml"):
-        print("Received a file of wrong format ", args.input.split(".")[-1], "\n")
-        quit()
+def extract(input, scheduleAttributesCbor, solvetype=None):
+    problemclass = input.split("/")[-4]
+    problemsubclass = input.split("/")[-3]
 
-    summaryResults = open("Summary.txt", "a")
-    problemclass = args.input.split("/")[-4]
-    problemsubclass = args.input.split("/")[-3]
-
-    canonjobs = args.input.split("_")[-5] if problemsubclass == "Canon2ReentrancyNormalDeadlinesNormalOrder" else None
+    canonjobs = input.split("_")[-5] if problemsubclass == CANON_SUBCLASS else None
     canonmachines = 4
 
-    results = {"name": args.input,
+    results = {"name": input,
                "class": problemclass,
                "subclass": problemsubclass,
-               "solveType": args.solvetype if args.solvetype else "unknown"
+               "solveType": solvetype if solvetype else "unknown"
                }
 
-    if os.path.exists(args.scheduleAttributesCbor):
-        with open(args.scheduleAttributesCbor, 'rb') as fp:
+    if os.path.exists(scheduleAttributesCbor):
+        with open(scheduleAttributesCbor, 'rb') as fp:
             obj = load(fp)
             # print(obj)
-            results.update({"jobs": obj["jobs"] if results[
-                                                       "subclass"] != "Canon2ReentrancyNormalDeadlinesNormalOrder" else canonjobs,
-                            "machines": obj["machines"] if results[
-                                                               "subclass"] != "Canon2ReentrancyNormalDeadlinesNormalOrder" else canonmachines,
+            results.update({"jobs": obj["jobs"] if results["subclass"] != CANON_SUBCLASS else canonjobs,
+                            "machines": obj["machines"] if results["subclass"] != CANON_SUBCLASS else canonmachines,
                             "solveTimePerJob": obj["timePerJob"] if "timePerJob" in obj else INFINITY,
                             "totalSolveTime": obj["totalTime"] if "totalTime" in obj else INFINITY,
                             "timeOut": obj["timeOutValue"],
                             "lowerBound": obj["lowerBound"] if "lowerBound" in obj else INFINITY,
                             "cborMakespan": obj["minMakespan"]})
+    return results
 
-    summaryResults.write(f"""{results["name"]}, \
+
+def formatResults(results):
+    return f"""{results["name"]}, \
                 {results["class"]}, \
                 {results["subclass"]}, \
                 {results["solveType"]},\
@@ -62,15 +85,103 @@ def run(args):
                 {results["solveTimePerJob"] if "solveTimePerJob" in results else INFINITY},\
                 {results["totalSolveTime"] if "totalSolveTime" in results else INFINITY},\
                 {results["cborMakespan"] if "cborMakespan" in results else INFINITY},\
-                {results["lowerBound"] if "lowerBound" in results else INFINITY} \n""")
+                {results["lowerBound"] if "lowerBound" in results else INFINITY} \n"""
+
+
+def run(args):
+    if (args.input.split(".")[-1] != "xml"):
+        print("Received a file of wrong format ", args.input.split(".")[-1], "\n")
+        quit()
+
+    results = extract(args.input, args.scheduleAttributesCbor, args.solvetype)
+    with open("Summary.txt", "a") as summaryResults:
+        summaryResults.write(formatResults(results))
 
     return results
 
 
+def findResults(inputFolder):
+    """
+    The (group, xml file, result cbor, solve type, per-result output path) of every instance and exploration type,
+    in the layout analyze_inputs.sh used to walk. Yields instances without a result with a None result cbor.
+    """
+    for model, explorations in EXPLORATION_TYPES.items():
+        group = f"Canon Flow Shops {model}"
+        canonInstances = os.path.join(inputFolder, "Instances", "FlowShops", CANON_SUBCLASS)
+        canonResults = os.path.join(inputFolder, "Results", model, "FlowShops", CANON_SUBCLASS)
+        for folder in sorted(glob(os.path.join(canonInstances, "*"))):
+            for xmlFile in sorted(glob(os.path.join(folder, "*.xml"))):
+                for exploration in explorations:
+                    name = f"{os.path.basename(folder)}{os.path.basename(xmlFile)}SAG{exploration}.txt.cbor"
+                    outPath = os.path.join(model, "FlowShops", CANON_SUBCLASS,
+                                           f"{os.path.basename(folder)}-{os.path.basename(xmlFile)}-{exploration}.txt")
+                    yield group, xmlFile, os.path.join(canonResults, name), f"{model}-{exploration}", outPath
+
+        for shopType in SHOP_TYPES:
+            for benchmarkFolder in BENCHMARK_FOLDERS:
+                group = f"{benchmarkFolder} {shopType} {model}"
+                instances = os.path.join(inputFolder, "Instances", shopType, benchmarkFolder)
+                results = os.path.join(inputFolder, "Results", model, shopType, benchmarkFolder)
+                for xmlFile in sorted(glob(os.path.join(instances, "*.xml"))):
+                    for exploration in explorations:
+                        name = f"{os.path.basename(xmlFile)}SAG{exploration}.txt.cbor"
+                        outPath = os.path.join(model, shopType, benchmarkFolder,
+                                               f"{os.path.basename(xmlFile)}-{exploration}.txt")
+                        yield group, xmlFile, os.path.join(results, name), f"{model}-{exploration}", outPath
+
+
+def extractRow(job):
+    xmlFile, resultFile, solvetype = job
+    try:
+        return formatResults(extract(xmlFile, resultFile, solvetype))
+    except Exception as e:
+        return e
+
+
+def runBatch(args):
+    found = list(findResults(args.batch))
+    jobs = [(xmlFile, resultFile, solvetype) for _, xmlFile, resultFile, solvetype, _ in found
+            if os.path.exists(resultFile)]
+    # one interpreter for everything, the cbor files are decoded in parallel and written in a fixed order
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        rows = iter(list(executor.map(extractRow, jobs, chunksize=max(1, len(jobs) // 256))))
+
+    counts = {}
+    with open(args.summary, "w") as summaryResults:
+        for group, xmlFile, resultFile, _, outPath in found:
+            count = counts.setdefault(group, [0, 0, 0])  # analyzed, skipped, failed
+            if not os.path.exists(resultFile):
+                count[1] += 1
+                continue
+            row = next(rows)
+            if isinstance(row, Exception):
+                print(f"Could not analyze {resultFile}: {row}")
+                count[2] += 1
+                continue
+            count[0] += 1
+            summaryResults.write(row)
+            if args.outFolder:
+                outPath = os.path.join(args.outFolder, outPath)
+                os.makedirs(os.path.dirname(outPath), exist_ok=True)
+                with open(outPath, "w") as f:
+                    f.write(row)
+
+    for group, (analyzed, skipped, failed) in counts.items():
+        print(f"Analyzing {group}")
+        print(f"Analyzed: {analyzed}")
+        print(f"Skipped: {skipped}")
+        if failed:
+            print(f"Failed: {failed}")
+    print(f"Summary written to {args.summary}")
+
+
 def main():
     parser = createParser()
     args = parser.parse_args()
-    run(args)
+    if args.batch:
+        runBatch(args)
+    else:
+        run(args)
 
 
 if __name__ == "__main__":
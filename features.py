@@ -0,0 +1,14 @@
+# The state features the models are trained on, in the order the model server feeds them to the model.
+# Kept in a module of its own so the model server does not have to import the sklearn model zoo in create_models.
+predict_keys = [
+    'machineCount',
+    'jobCount',
+    'opCount',
+    'vertexDepth',
+    'avgOpTime',
+    'minOpTime',
+    'maxOpTime',
+    'idleTime',
+    'opsRemaining',
+    'alapST'
+]
@@ -0,0 +1,107 @@
+import json
+import os
+import time
+from typing import Dict, Optional
+
+# Sub-buckets per power of two: values are recorded with a relative precision of 2^-(SUB_BUCKET_BITS - 1) (~3%)
+SUB_BUCKET_BITS = 6
+SUB_BUCKET_HALF = 1 << (SUB_BUCKET_BITS - 1)
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram:
+    """
+    HDR-style log-linear histogram of non-negative integers (e.g. latencies in ns).
+    Values below 2^SUB_BUCKET_BITS get their own bucket, larger values share a bucket with values that differ only
+    in bits below the top SUB_BUCKET_BITS. Recording is a few integer operations, so it can stay on in the hot path.
+    """
+
+    def __init__(self):
+        self.counts = [0] * ((64 - SUB_BUCKET_BITS + 2) * SUB_BUCKET_HALF)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def bucket(value: int) -> int:
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        return shift * SUB_BUCKET_HALF + (value >> shift)
+
+    @staticmethod
+    def bucket_range(bucket: int):
+        """The lowest and highest value that end up in the bucket"""
+        shift = max(0, bucket // SUB_BUCKET_HALF - 1)
+        lowest = (bucket - shift * SUB_BUCKET_HALF) << shift
+        return lowest, lowest + (1 << shift) - 1
+
+    def record(self, value: int) -> None:
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile: float) -> int:
+        if self.count == 0:
+            return 0
+        target = max(1, int(self.count * percentile / 100 + 0.5))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_range(bucket)[1], self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        summary = {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'min': self.min or 0,
+            'max': self.max,
+        }
+        for percentile in PERCENTILES:
+            summary[f'p{percentile:g}'] = self.percentile(percentile)
+        return summary
+
+
+class ServerStats:
+    """Always-on counters and per-stage latency histograms (in ns) of a model server process"""
+    stages = ('recv', 'decode', 'predict', 'send')
+
+    def __init__(self):
+        self.started = time.time()
+        self.connections = 0
+        self.requests = 0
+        self.states = 0
+        self.latencies: Dict[str, Histogram] = {stage: Histogram() for stage in self.stages}
+        self.batch_sizes = Histogram()
+        self.extra: Dict[str, object] = {}  # objects with a stats() method, e.g. the prediction cache
+
+    def record(self, stage: str, start_ns: int, end_ns: int) -> None:
+        latencies = self.latencies.get(stage)
+        if latencies is None:
+            latencies = self.latencies[stage] = Histogram()
+        latencies.record(end_ns - start_ns)
+
+    def snapshot(self) -> dict:
+        return {
+            'pid': os.getpid(),
+            'uptimeSeconds': time.time() - self.started,
+            'connections': self.connections,
+            'requests': self.requests,
+            'states': self.states,
+            'latencyNs': {stage: latencies.summary() for stage, latencies in self.latencies.items()},
+            'batchSizes': self.batch_sizes.summary(),
+            **{name: source.stats() for name, source in self.extra.items()},
+        }
+
+    def save(self, path: str, suffix: Optional[str] = None) -> None:
+        if suffix:
+            path = f"{path}.{suffix}"
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=4)
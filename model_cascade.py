@@ -0,0 +1,58 @@
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Optional
+
+import numpy as np
+
+
+class ModelCascade:
+    """
+    Answers with the primary model if it predicts within `budget` seconds, otherwise with the (cheap) fallback model.
+    The primary model runs in a worker thread, so a late prediction is abandoned instead of waited for; while it is
+    still running, later requests go to the fallback straight away. If the primary model raises, the fallback answers.
+    Behaves like a model (it has a predict method), so it can be used wherever the model is used.
+    """
+
+    def __init__(self, primary, fallback, budget: float):
+        self.primary = primary
+        self.fallback = fallback
+        self.budget = budget
+        # created on first use, so forked workers each start their own thread
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.running: Optional[Future] = None
+        self.primary_answers = 0
+        self.timeouts = 0
+        self.busy = 0
+        self.errors = 0
+
+    def predict(self, X) -> np.ndarray:
+        if self.running is not None and not self.running.done():
+            self.busy += 1
+            return self.fallback.predict(X)
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='primary-model')
+        self.running = self.executor.submit(self.primary.predict, X)
+        try:
+            y = self.running.result(timeout=self.budget)
+        except TimeoutError:
+            self.timeouts += 1
+            return self.fallback.predict(X)
+        except Exception as e:
+            print(f"Primary model failed, using the fallback: {e}")
+            self.errors += 1
+            return self.fallback.predict(X)
+        self.primary_answers += 1
+        return y
+
+    def stats(self) -> dict:
+        fallbacks = self.timeouts + self.busy + self.errors
+        requests = self.primary_answers + fallbacks
+        return {
+            'budgetMs': self.budget * 1e3,
+            'primary': self.primary_answers,
+            'fallbacks': fallbacks,
+            'timeouts': self.timeouts,
+            'busy': self.busy,
+            'errors': self.errors,
+            'fallbackRate': fallbacks / requests if requests else 0.0,
+        }
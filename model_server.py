@@ -1,17 +1,44 @@
 #!/usr/bin/env python3
+import asyncio
+import gc
 import json
+import signal
 import socket
 import os
 import sys
 import struct
+import threading
 from argparse import ArgumentParser
-from typing import Optional
-from joblib import load
-from create_models import predict_keys
+from typing import List, Optional, Tuple
+import numpy as np
+from features import predict_keys
+from latency_stats import ServerStats
+from model_cascade import ModelCascade
+from prediction_cache import PredictionCache, model_fingerprint
+from shm_transport import ShmRing, serve_ring
 import time
 
+# compiled models (src/compiled_models.py) must be importable to unpickle them
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from compiled_models import load_model
 
-def connect(socket_path: str) -> socket:
+# Every frame starts with a native 4-byte size header. Frames with the high bit set in the header carry
+# a control message (e.g. the binary protocol handshake) instead of a prediction request.
+HEADER = struct.Struct('I')
+CONTROL_FLAG = 1 << 31
+
+# Binary protocol: requests are packed native float64 feature vectors (one or more rows, in the feature
+# order agreed on in the handshake), replies are packed native int64 predictions (one per row).
+FEATURE_DTYPE = np.dtype(np.float64)
+PREDICTION_DTYPE = np.dtype(np.int64)
+
+# With request IDs (agreed on in the handshake), every request payload starts with a native uint64 ID that is
+# repeated at the start of its reply, so a client can keep many requests outstanding and the server may answer
+# them in any order.
+REQUEST_ID = struct.Struct('Q')
+
+
+def connect(socket_path: str, backlog: int = 1) -> socket:
     try:
         os.unlink(socket_path)
     except OSError:
@@ -26,29 +53,650 @@ def connect(socket_path: str) -> socket:
         print('Bind failed. Error:', str(sys.exc_info()), 'Message:', msg)
         sys.exit()
 
-    s.listen(1)
+    s.listen(backlog)
     return s
 
 
+def send_frame(c: socket, payload: bytes, control: bool = False) -> None:
+    header = len(payload) | CONTROL_FLAG if control else len(payload)
+    c.sendall(HEADER.pack(header) + payload)
+
+
 def send_message(c: socket, msg: str) -> None:
-    msg_size = len(msg)
-    c.sendall(struct.pack('I', msg_size))
-    c.sendall(msg.encode('utf-8'))
+    send_frame(c, msg.encode('utf-8'))
+
+
+def recv_exact_into(c: socket, view: memoryview) -> bool:
+    """
+    Fills the whole buffer from the socket, handling partial reads.
+    Returns False if the peer closed the connection before sending anything.
+    """
+    received = 0
+    while received < len(view):
+        n = c.recv_into(view[received:])
+        if n == 0:
+            if received == 0:
+                return False
+            raise ConnectionError("Connection closed in the middle of a frame")
+        received += n
+    return True
+
+
+def recv_exact(c: socket, size: int) -> Optional[bytes]:
+    buffer = bytearray(size)
+    if size and not recv_exact_into(c, memoryview(buffer)):
+        return None
+    return bytes(buffer)
+
+
+def recv_header(c: socket) -> Optional[Tuple[int, bool]]:
+    """Returns the payload size and whether the frame is a control message, or None when the peer is done"""
+    data = recv_exact(c, HEADER.size)
+    if data is None:
+        return None
+    header = HEADER.unpack(data)[0]
+    return header & ~CONTROL_FLAG, bool(header & CONTROL_FLAG)
 
 
 def recv_message(c: socket) -> Optional[str]:
-    data = c.recv(4)
-    if not data:
+    header = recv_header(c)
+    if header is None:
         return None
-    msg_size = struct.unpack('I', data)[0]
-    return c.recv(msg_size, socket.MSG_WAITALL).decode('utf-8')
+    data = recv_exact(c, header[0])
+    if data is None:
+        raise ConnectionError("Connection closed in the middle of a frame")
+    return data.decode('utf-8')
+
+
+def send_control(c: socket, command: str, arguments: Optional[dict] = None) -> None:
+    msg = command if arguments is None else f"{command} {json.dumps(arguments)}"
+    send_frame(c, msg.encode('utf-8'), control=True)
+
+
+def parse_control(payload: bytes) -> Tuple[str, dict]:
+    command, _, arguments = payload.decode('utf-8').partition(' ')
+    return command, json.loads(arguments) if arguments else {}
+
+
+def get_features(state_data: dict) -> List[float]:
+    x = []
+    for key in predict_keys:
+        if key not in state_data:
+            raise Exception(f"key '{key}' not in state data")
+        x.append(state_data[key])
+    return x
+
+
+def decode_states(msg: str) -> Tuple[np.ndarray, bool]:
+    """
+    Decodes a message into a feature matrix.
+    A single state is sent as a JSON object, a batch of states as a JSON array of objects.
+    Returns the feature matrix (one row per state) and whether the message was a batch.
+    """
+    state_data = json.loads(msg)
+    if isinstance(state_data, list):
+        return np.array([get_features(s) for s in state_data], dtype=np.float64).reshape(-1, len(predict_keys)), True
+    return np.array([get_features(state_data)], dtype=np.float64), False
+
+
+class BinaryDecoder:
+    """
+    Receives packed feature vectors straight into a reusable buffer.
+    The client's feature order is agreed on once in the handshake; it may contain extra features,
+    but it must contain every key in predict_keys.
+    """
+
+    def __init__(self, features: List[str]):
+        missing = [key for key in predict_keys if key not in features]
+        if missing:
+            raise Exception(f"keys {missing} not in handshake features")
+        self.width = len(features)
+        self.row_size = self.width * FEATURE_DTYPE.itemsize
+        order = [features.index(key) for key in predict_keys]
+        # the common case (client uses our order) needs no column shuffling at all
+        self.order = None if order == list(range(self.width)) else order
+        self.buffer = np.empty(0, dtype=FEATURE_DTYPE)
+
+    def rows(self, size: int) -> int:
+        if size % self.row_size != 0:
+            raise Exception(f"Frame of {size} bytes is not a whole number of {self.width}-feature rows")
+        return size // self.row_size
+
+    def reorder(self, X: np.ndarray) -> np.ndarray:
+        X = X.reshape(-1, self.width)
+        return X if self.order is None else X[:, self.order]
+
+    def decode(self, payload: bytes) -> np.ndarray:
+        self.rows(len(payload))
+        return self.reorder(np.frombuffer(payload, dtype=FEATURE_DTYPE))
+
+    def recv(self, c: socket, size: int) -> np.ndarray:
+        rows = self.rows(size)
+        if self.buffer.size < rows * self.width:
+            self.buffer = np.empty(max(rows * self.width, 2 * self.buffer.size), dtype=FEATURE_DTYPE)
+        X = self.buffer[:rows * self.width]
+        if size and not recv_exact_into(c, memoryview(X).cast('B')):
+            raise ConnectionError("Connection closed in the middle of a frame")
+        return self.reorder(X)
+
+
+class Protocol:
+    """What a connection agreed on in the handshake: the binary decoder (None for JSON) and the use of request IDs"""
+
+    def __init__(self, decoder: Optional[BinaryDecoder] = None, request_ids: bool = False):
+        self.decoder = decoder
+        self.request_ids = request_ids
+
+    def decode(self, payload: bytes) -> Tuple[Optional[int], np.ndarray, bool]:
+        """Returns the request ID (None without request IDs), the feature matrix and whether the request was a batch"""
+        request_id = None
+        if self.request_ids:
+            if len(payload) < REQUEST_ID.size:
+                raise Exception(f"Request of {len(payload)} bytes is too short to contain a request ID")
+            request_id = REQUEST_ID.unpack_from(payload)[0]
+            payload = memoryview(payload)[REQUEST_ID.size:]
+        if self.decoder is not None:
+            return request_id, self.decoder.decode(payload), True
+        X, batched = decode_states(str(payload, 'utf-8'))
+        return request_id, X, batched
+
+    def encode(self, request_id: Optional[int], y: np.ndarray, batched: bool) -> bytes:
+        if self.decoder is not None:
+            reply = y.astype(PREDICTION_DTYPE).tobytes()
+        else:
+            reply = encode_predictions(y, batched).encode('utf-8')
+        return reply if request_id is None else REQUEST_ID.pack(request_id) + reply
+
+
+def handshake(arguments: dict) -> Tuple[Protocol, dict]:
+    """Handles a 'hello' control message, returns the protocol to use for the connection and the reply"""
+    protocol = arguments.get('protocol', 'json')
+    request_ids = bool(arguments.get('requestIds', False))
+    if protocol == 'json':
+        return Protocol(None, request_ids), {'ok': True, 'protocol': protocol, 'requestIds': request_ids}
+    if protocol != 'binary':
+        return Protocol(), {'ok': False, 'error': f"Unknown protocol '{protocol}'"}
+    try:
+        decoder = BinaryDecoder(arguments.get('features', predict_keys))
+    except Exception as e:
+        return Protocol(), {'ok': False, 'error': str(e)}
+    return Protocol(decoder, request_ids), {
+        'ok': True,
+        'protocol': protocol,
+        'requestIds': request_ids,
+        'features': predict_keys,
+        'featureDtype': FEATURE_DTYPE.str,
+        'predictionDtype': PREDICTION_DTYPE.str,
+    }
+
+
+def handle_control(payload: bytes, protocol: Protocol, stats: ServerStats) -> Tuple[Protocol, bytes]:
+    """Handles a control message, returns the protocol to use for the rest of the connection and the reply"""
+    command, arguments = parse_control(payload)
+    if command == 'hello':
+        protocol, reply = handshake(arguments)
+    elif command == 'ping':
+        reply = {'ok': True}
+    elif command == 'stats':
+        reply = {'ok': True, 'stats': stats.snapshot()}
+    elif command == 'shm':
+        # single mode switches to the ring before getting here, the async server has no thread to spin on a ring
+        reply = {'ok': False, 'error': "The shared-memory transport is only available in single mode"}
+    else:
+        reply = {'ok': False, 'error': f"Unknown control message '{command}'"}
+    return protocol, json.dumps(reply).encode('utf-8')
+
+
+def predict(model, X: np.ndarray) -> np.ndarray:
+    if len(X) == 0:
+        return np.empty(0)
+    # some models (e.g. PLSR) return a column vector instead of a flat array
+    return np.asarray(model.predict(X)).reshape(len(X), -1)[:, 0]
+
+
+def warmup(model, rounds: int) -> None:
+    """Runs a few predictions so the first real request does not pay for lazy initialization"""
+    for batch_size in (1, 64):
+        X = np.zeros((batch_size, len(predict_keys)))
+        for _ in range(rounds):
+            predict(model, X)
+
+
+def signal_ready(ready_file: str) -> None:
+    # written atomically, so a launcher polling for the file never sees it half-written
+    tmp_file = f"{ready_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write(f"{os.getpid()}\n")
+    os.replace(tmp_file, ready_file)
+
+
+def encode_predictions(y: np.ndarray, batched: bool) -> str:
+    if batched:
+        return json.dumps([int(v) for v in y])
+    return str(int(y[0]))
+
+
+def data_frame_waiting(c: socket) -> bool:
+    """Whether the header of a request frame has already arrived, without blocking"""
+    try:
+        data = c.recv(HEADER.size, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return False
+    return len(data) == HEADER.size and not HEADER.unpack(data)[0] & CONTROL_FLAG
+
+
+def serve_pipelined(c: socket, model, stats: ServerStats, protocol: Protocol, size: int, max_batch_size: int) -> None:
+    """
+    Serves a request with a request ID together with the requests the client has pipelined behind it:
+    every request frame that is already waiting on the socket (up to max_batch_size states) is predicted in one call.
+    """
+    requests = []
+    states = 0
+    while True:
+        t_recv = time.perf_counter_ns()
+        payload = recv_exact(c, size)
+        if payload is None:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        t_decode = time.perf_counter_ns()
+        request_id, X, batched = protocol.decode(payload)
+        stats.record('recv', t_recv, t_decode)
+        stats.record('decode', t_decode, time.perf_counter_ns())
+        requests.append((request_id, X, batched))
+        states += len(X)
+        if states >= max_batch_size or not data_frame_waiting(c):
+            break
+        size = recv_header(c)[0]
+
+    t_predict = time.perf_counter_ns()
+    y = predict(model, np.concatenate([X for _, X, _ in requests]))
+    t_predicted = time.perf_counter_ns()
+    offset = 0
+    for request_id, X, batched in requests:
+        send_frame(c, protocol.encode(request_id, y[offset:offset + len(X)], batched))
+        offset += len(X)
+
+    stats.requests += len(requests)
+    stats.states += states
+    stats.batch_sizes.record(states)
+    stats.record('predict', t_predict, t_predicted)
+    stats.record('send', t_predicted, time.perf_counter_ns())
+
+
+def serve_connection(c: socket, model, stats: ServerStats, max_batch_size: int, debug: bool = False) -> None:
+    """
+    Serves requests until the client disconnects.
+    The recv stage is timed from the moment the header has arrived, so time spent waiting for the client's next
+    request is not counted.
+    """
+    stats.connections += 1
+    protocol = Protocol()
+    while True:
+        if debug:
+            print('Waiting...')
+        header = recv_header(c)
+        if header is None:
+            print("No more data")
+            break
+        size, control = header
+
+        if control:
+            payload = recv_exact(c, size) or b''
+            command, arguments = parse_control(payload)
+            if command == 'shm':
+                if serve_shm(c, model, stats, arguments):
+                    break
+                continue
+            protocol, reply = handle_control(payload, protocol, stats)
+            if debug:
+                print(f"Control reply: {reply!r}")
+            send_frame(c, reply, control=True)
+            continue
+
+        if protocol.request_ids:
+            serve_pipelined(c, model, stats, protocol, size, max_batch_size)
+            continue
+
+        t_recv = time.perf_counter_ns()
+        if protocol.decoder is not None:
+            X = protocol.decoder.recv(c, size)
+            batched = True
+            t_decode = t_decoded = time.perf_counter_ns()
+            if debug:
+                print(f"Received {len(X)} packed states")
+        else:
+            x = (recv_exact(c, size) or b'').decode('utf-8')
+            t_decode = time.perf_counter_ns()
+            if debug:
+                print(f"Received: '{x}'")
+            X, batched = decode_states(x)
+            t_decoded = time.perf_counter_ns()
+
+        y = predict(model, X)
+        t_predicted = time.perf_counter_ns()
+        if debug:
+            print(f"prediction took: {t_predicted - t_decoded}*10^-9s")
+
+        reply = protocol.encode(None, y, batched)
+        send_frame(c, reply)
+        t_sent = time.perf_counter_ns()
+        if debug:
+            print(f"Sent: {reply!r}")
+
+        stats.requests += 1
+        stats.states += len(X)
+        stats.batch_sizes.record(len(X))
+        stats.record('recv', t_recv, t_decode)
+        stats.record('decode', t_decode, t_decoded)
+        stats.record('predict', t_decoded, t_predicted)
+        stats.record('send', t_predicted, t_sent)
+
+
+def serve_shm(c: socket, model, stats: ServerStats, arguments: dict) -> bool:
+    """
+    Switches the connection to the shared-memory ring transport (see shm_transport.py) until the client disconnects.
+    The 'shm' control message takes the client's feature order (like the binary protocol), the number of slots
+    and the maximum number of states per slot; the reply contains the name of the shared memory block.
+    Returns False if the ring could not be set up, the connection then continues on the socket.
+    """
+    try:
+        decoder = BinaryDecoder(arguments.get('features', predict_keys))
+        ring = ShmRing.create(int(arguments.get('slots', 64)), int(arguments.get('maxRows', 64)), decoder.width)
+    except Exception as e:
+        send_frame(c, json.dumps({'ok': False, 'error': str(e)}).encode('utf-8'), control=True)
+        return False
+
+    def on_batch(requests: int, states: int, predict_ns: int):
+        stats.requests += requests
+        stats.states += states
+        stats.batch_sizes.record(states)
+        stats.record('predict', 0, predict_ns)
+
+    try:
+        reply = {'ok': True, 'name': ring.shm.name, 'slots': ring.slots, 'maxRows': ring.max_rows,
+                 'width': ring.width}
+        send_frame(c, json.dumps(reply).encode('utf-8'), control=True)
+        serve_ring(c, ring, lambda X: predict(model, X), decoder.reorder, on_batch)
+    finally:
+        ring.close(unlink=True)
+    return True
+
+
+def serve(s: socket, model, stats: ServerStats, max_batch_size: int, debug: bool = False) -> None:
+    """Serves one client at a time until it disconnects"""
+    while True:
+        print('Waiting for first message...')
+        c, addr = s.accept()
+        try:
+            serve_connection(c, model, stats, max_batch_size, debug)
+        except Exception as e:
+            print(f"Exception: {e}")
+        finally:
+            c.close()
+
+
+class DynamicBatcher:
+    """
+    Groups the requests of all connections into vectorized predict calls.
+    After the first request of a batch arrives, the batcher waits up to `window` seconds for more requests,
+    but never delays a request more than `max_wait` seconds after it arrived, and stops collecting once
+    `max_batch_size` states have been gathered.
+    """
+
+    def __init__(self, model, stats: ServerStats, window: float, max_batch_size: int, max_wait: float):
+        self.model = model
+        self.stats = stats
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def predict(self, X: np.ndarray) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put_nowait((X, future, loop.time()))
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            X, future, arrived = await self.queue.get()
+            batch = [(X, future)]
+            size = len(X)
+            deadline = min(loop.time() + self.window, arrived + self.max_wait)
+            while size < self.max_batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        X, future, _ = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    X, future, _ = self.queue.get_nowait()
+                batch.append((X, future))
+                size += len(X)
+
+            try:
+                t_start = time.perf_counter_ns()
+                y = predict(self.model, np.concatenate([X for X, _ in batch]))
+                self.stats.record('predict', t_start, time.perf_counter_ns())
+                self.stats.batch_sizes.record(len(y))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            offset = 0
+            for X, future in batch:
+                if not future.done():
+                    future.set_result(y[offset:offset + len(X)])
+                offset += len(X)
+
+
+async def answer_request(writer: asyncio.StreamWriter, batcher: DynamicBatcher, stats: ServerStats,
+                         protocol: Protocol, request_id: Optional[int], X: np.ndarray, batched: bool) -> None:
+    t_decoded = time.perf_counter_ns()
+    y = await batcher.predict(X)
+    t_predicted = time.perf_counter_ns()
+    reply = protocol.encode(request_id, y, batched)
+    writer.write(HEADER.pack(len(reply)) + reply)
+    await writer.drain()
+
+    stats.requests += 1
+    stats.states += len(X)
+    stats.record('batch', t_decoded, t_predicted)
+    stats.record('send', t_predicted, time.perf_counter_ns())
+
+
+async def answer_pipelined(writer: asyncio.StreamWriter, batcher: DynamicBatcher, stats: ServerStats,
+                           protocol: Protocol, request_id: int, X: np.ndarray, batched: bool) -> None:
+    try:
+        await answer_request(writer, batcher, stats, protocol, request_id, X, batched)
+    except Exception as e:
+        # the client would wait for this reply forever, drop the connection instead
+        print(f"Exception answering request {request_id}: {e}")
+        writer.close()
+
+
+async def serve_async_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                 batcher: DynamicBatcher, stats: ServerStats, debug: bool = False) -> None:
+    """
+    Serves requests until the client disconnects.
+    Besides the predict call itself (recorded by the batcher), the 'batch' stage records how long each request
+    waited for its batch to be predicted.
+    With request IDs, every request is answered by its own task as soon as its batch is done, while the next
+    requests are read right away, so requests pipelined on one connection end up in the same batches.
+    """
+    stats.connections += 1
+    protocol = Protocol()
+    pending = set()
+    try:
+        while True:
+            try:
+                data = await reader.readexactly(HEADER.size)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise ConnectionError("Connection closed in the middle of a frame")
+                if debug:
+                    print("No more data")
+                break
+            header = HEADER.unpack(data)[0]
+            t_recv = time.perf_counter_ns()
+            payload = await reader.readexactly(header & ~CONTROL_FLAG)
+
+            if header & CONTROL_FLAG:
+                protocol, reply = handle_control(payload, protocol, stats)
+                writer.write(HEADER.pack(len(reply) | CONTROL_FLAG) + reply)
+                await writer.drain()
+                continue
+
+            t_decode = time.perf_counter_ns()
+            request_id, X, batched = protocol.decode(payload)
+            stats.record('recv', t_recv, t_decode)
+            stats.record('decode', t_decode, time.perf_counter_ns())
+            if request_id is None:
+                await answer_request(writer, batcher, stats, protocol, None, X, batched)
+                continue
+            task = asyncio.create_task(answer_pipelined(writer, batcher, stats, protocol, request_id, X, batched))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    except Exception as e:
+        print(f"Exception: {e}")
+    finally:
+        if pending:
+            await asyncio.gather(*pending)
+        writer.close()
+
+
+async def serve_async(s: socket, model, stats: ServerStats, batch_window: float, max_batch_size: int,
+                      max_wait: float, debug: bool = False) -> None:
+    """Serves many clients concurrently from one event loop, batching their requests together"""
+    batcher = DynamicBatcher(model, stats, batch_window, max_batch_size, max_wait)
+    batcher_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: serve_async_connection(reader, writer, batcher, stats, debug),
+        sock=s,
+    )
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher_task.cancel()
+
+
+def exit_with_parent(alive_fd: int) -> None:
+    # the master never writes to this pipe, so the read only returns once the master is gone (even on kill -9)
+    os.read(alive_fd, 1)
+    os._exit(0)
+
+
+def serve_prefork(workers: int, serve_worker) -> None:
+    """
+    Forks worker processes that all accept connections on the inherited listening socket.
+    The model is loaded once in the master; gc.freeze() keeps the garbage collector from touching the
+    loaded objects, so the workers share the model's pages copy-on-write instead of each holding a copy.
+    Workers that die are restarted until the master receives SIGTERM or SIGINT.
+    """
+    gc.collect()
+    gc.freeze()
+    alive_r, alive_w = os.pipe()
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # let the worker clean up (e.g. write its stats) when the master stops it
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            os.close(alive_w)
+            threading.Thread(target=exit_with_parent, args=(alive_r,), daemon=True).start()
+            code = 0
+            try:
+                serve_worker()
+            except SystemExit:
+                pass
+            except Exception as e:
+                print(f"Exception in worker {os.getpid()}: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    print(f"Started {workers} workers")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, restarting")
+            time.sleep(0.1)
+            spawn()
+    os.close(alive_w)
+
+
+def run_server(s: socket, model, stats: ServerStats, args, worker: bool = False) -> None:
+    try:
+        if args.mode == 'async':
+            asyncio.run(serve_async(s, model, stats, args.batch_window_us / 1e6, args.max_batch_size,
+                                    args.max_wait_us / 1e6, args.debug))
+        else:
+            serve(s, model, stats, args.max_batch_size, args.debug)
+    finally:
+        if args.stats_file:
+            # every worker keeps its own stats
+            stats.save(args.stats_file, str(os.getpid()) if worker else None)
 
 
 def parse_args():
     parser = ArgumentParser(description='Predict ML Values for states')
     parser.add_argument('socket_path', type=str, action='store', help='Path to socket lib')
-    parser.add_argument('model_path', type=str, action='store', help='Path to the joblib model')
+    parser.add_argument('model_path', type=str, action='store', help='Path to the joblib model (sklearn or compiled)')
     parser.add_argument('--debug', action='store_true', help='Print debug messages')
+    parser.add_argument('--mode', choices=['single', 'async'], default='single',
+                        help='single: serve one client at a time, async: serve many clients from one event loop')
+    parser.add_argument('--batch-window-us', type=int, default=0,
+                        help='(async) Time to wait for more requests after the first request of a batch')
+    parser.add_argument('--max-batch-size', type=int, default=256,
+                        help='(async, or pipelined requests in single mode) Maximum number of states to predict in '
+                             'one call')
+    parser.add_argument('--max-wait-us', type=int, default=1000,
+                        help='(async) Maximum time a request can be delayed to batch it with others')
+    parser.add_argument('--fallback-model', type=str,
+                        help='Cheap model (e.g. DTR) that answers when the model misses --latency-budget-ms')
+    parser.add_argument('--latency-budget-ms', type=float, default=5,
+                        help='(with --fallback-model) Time the model gets to predict a request before the fallback '
+                             'model answers it')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='Number of warmup predictions to run before accepting requests')
+    parser.add_argument('--ready-file', type=str,
+                        help='Create this file once the server is listening and warmed up')
+    parser.add_argument('--stats-file', type=str,
+                        help='Write counters and per-stage latency percentiles (JSON) to this file on shutdown '
+                             '(with --workers, one file per worker, suffixed with its pid)')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='Cache up to this many predictions, keyed on the feature vector (0: no cache)')
+    parser.add_argument('--cache-file', type=str,
+                        help='Load the prediction cache from this file on startup and save it on shutdown')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes to fork, sharing one loaded model (1: no forking)')
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='(async or workers > 1) Maximum number of pending connections')
     return parser.parse_args()
 
 
@@ -57,50 +705,51 @@ if __name__ == '__main__':
 
     if not os.path.exists(args.model_path):
         raise Exception("Invalid model path")
+    if args.fallback_model and not os.path.exists(args.fallback_model):
+        raise Exception("Invalid fallback model path")
 
     print(f"Starting server on {args.socket_path}")
-    s = connect(args.socket_path)
-    model = load(args.model_path)
+    s = connect(args.socket_path, args.backlog if args.mode == 'async' or args.workers > 1 else 1)
+    model = load_model(args.model_path)
     print("Model loaded")
+    warmup(model, args.warmup)
 
-    try:
-        while True:
-            print('Waiting for first message...')
-            c, addr = s.accept()
-            try:
-                while True:
-                    if args.debug:
-                        print('Waiting...')
-                    x = recv_message(c)
-                    if not x:
-                        print("No more data")
-                        break
+    stats = ServerStats()
+    cache = None
+    if args.cache_size > 0:
+        model = cache = PredictionCache(model, args.cache_size)
+        stats.extra['cache'] = cache
+        if args.cache_file and cache.load(args.cache_file, model_fingerprint(args.model_path)):
+            print(f"Loaded {len(cache.entries)} cached predictions")
+    if args.fallback_model:
+        # the cache only holds predictions of the model itself, including the ones that missed the budget
+        fallback = load_model(args.fallback_model)
+        warmup(fallback, args.warmup)
+        model = ModelCascade(model, fallback, args.latency_budget_ms / 1e3)
+        stats.extra['cascade'] = model
+        print(f"Fallback model loaded, latency budget {args.latency_budget_ms}ms")
 
-                    start = time.time_ns()
-                    if args.debug:
-                        print(f"Received: '{x}'")
-                    state_data = json.loads(x)
-                    x = []
-                    for key in predict_keys:
-                        if key not in state_data:
-                            raise Exception(f"key '{key}' not in state data")
-                        x.append(state_data[key])
-
-                    y = str(int(model.predict([x])[0]))
-
-                    end = time.time_ns()
-                    if args.debug:
-                        print(f"prediction took: {end - start}*10^-9s")
-
-                    send_message(c, y)
-                    if args.debug:
-                        print(f"Sent: '{y}'")
-            except Exception as e:
-                print(f"Exception: {e}")
-            finally:
-                c.close()
+    try:
+        # connections made from here on queue up on the listening socket until a worker accepts them
+        if args.ready_file:
+            signal_ready(args.ready_file)
+            print("Ready")
+        if args.workers > 1:
+            # every worker gets its own copy of the (warm) cache, only a single-process server saves it
+            serve_prefork(args.workers, lambda: run_server(s, model, stats, args, worker=True))
+        else:
+            # exit through the finally block below on SIGTERM, so the cache is saved
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            run_server(s, model, stats, args)
     except Exception as e:
         print(f"Exception: {e}")
     finally:
+        if cache is not None:
+            print(f"Prediction cache: {cache.stats()}")
+            if args.cache_file and args.workers <= 1:
+                cache.save(args.cache_file, model_fingerprint(args.model_path))
+                print(f"Saved {len(cache.entries)} cached predictions")
+        if args.ready_file and os.path.exists(args.ready_file):
+            os.unlink(args.ready_file)
         s.close()
         os.unlink(args.socket_path)
@@ -1,15 +1,25 @@
 # benchmarc of the unix sockets model server protocol
 
+import json
 import os
+import shlex
 import socket
-from model_server import connect, send_message, recv_message, predict_keys
+import subprocess
+import sys
+import numpy as np
+from model_server import connect, send_message, recv_message, predict_keys, send_control, send_frame, recv_header, \
+    recv_exact, PREDICTION_DTYPE, REQUEST_ID
+from shm_transport import ShmClient
 from matplotlib import pyplot as plt
-from typing import Callable, List, Dict
+from typing import Callable, List, Dict, Optional
 from argparse import ArgumentParser, Namespace
 from time import time_ns, sleep
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 
 POLL_TIMEOUT_SECONDS = 0.2
+SERVER_READY_TIMEOUT_SECONDS = 120
+# relative change in throughput or p99 latency that counts as a regression in compare mode
+DEFAULT_REGRESSION_THRESHOLD = 0.1
 
 def main():
     parser = ArgumentParser(description='Benchmark model server')
@@ -18,8 +28,25 @@ def main():
     parser.add_argument('-n', '--num_messages', type=int, action='store', help='Number of messages to send', default=10_000)
     parser.add_argument('-p', '--plot-dir', type=str, action='store', help='Directory to save plots', default='plots')
     parser.add_argument('-w', '--warmup-messages', type=int, action='store', help='Number of messages to send before benchmarking', default=10_000)
+    parser.add_argument('--models', type=str, nargs='+', action='store', help='Benchmark the real model server with these models instead of an echo server')
+    parser.add_argument('--clients', type=int, nargs='+', action='store', help='(real) Numbers of concurrent clients to sweep', default=[1, 4])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', action='store', help='(real) Numbers of states per request to sweep', default=[1, 16])
+    parser.add_argument('--protocol', type=str, choices=['json', 'binary'], action='store', help='(real) Protocol the clients use', default='json')
+    parser.add_argument('--transport', type=str, choices=['socket', 'shm'], action='store', help='(real) Send requests over the socket or the shared-memory ring (which ignores --protocol)', default='socket')
+    parser.add_argument('--pipeline', type=int, action='store', help='(real) Requests every client keeps outstanding, using request IDs if more than 1 (socket transport)', default=1)
+    parser.add_argument('--states', type=str, action='store', help='(real) jsonl file (e.g. test.jsonl) to take state payloads from, random states if not given')
+    parser.add_argument('--server-args', type=str, action='store', help='(real) Extra arguments for model_server.py, e.g. "--mode async"', default='')
+    parser.add_argument('--results', type=str, action='store', help='(real) JSON file to write the results to', default='benchmark-results.json')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('OLD', 'NEW'), action='store', help='Compare two result files and flag regressions')
+    parser.add_argument('--threshold', type=float, action='store', help='(compare) Relative change that counts as a regression', default=DEFAULT_REGRESSION_THRESHOLD)
     args = parser.parse_args()
 
+    if args.compare:
+        sys.exit(1 if compare_results(*args.compare, args.threshold) else 0)
+    if args.models:
+        run_real_benchmarks(args)
+        return
+
     MAX_MESSAGE_SIZE = 0xffffffff
     for size_bytes in args.message_size:
         if size_bytes > MAX_MESSAGE_SIZE:
@@ -81,6 +108,211 @@ def server_fn(socket_path: str, response_size_bytes: int):
         os.unlink(socket_path)
 
 
+def load_states(path: Optional[str], count: int) -> np.ndarray:
+    """Feature rows to send: taken from a jsonl dataset if given, otherwise random integer states"""
+    if path is None:
+        return np.random.default_rng(1).integers(0, 1000, size=(count, len(predict_keys))).astype(np.float64)
+    rows = []
+    with open(path) as f:
+        for line in f:
+            data = json.loads(line)
+            rows.append([data[key] for key in predict_keys])
+            if len(rows) >= count:
+                break
+    return np.array(rows, dtype=np.float64)
+
+
+def start_server(socket_path: str, model_path: str, server_args: List[str]) -> subprocess.Popen:
+    ready_file = f"{socket_path}.ready"
+    if os.path.exists(ready_file):
+        os.unlink(ready_file)
+    server_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_server.py')
+    server = subprocess.Popen(
+        [sys.executable, server_file, socket_path, model_path, '--ready-file', ready_file, *server_args],
+        stdout=subprocess.DEVNULL,
+    )
+    for _ in range(int(SERVER_READY_TIMEOUT_SECONDS / POLL_TIMEOUT_SECONDS)):
+        if os.path.exists(ready_file):
+            return server
+        if server.poll() is not None:
+            raise Exception(f"Model server exited with code {server.returncode}")
+        sleep(POLL_TIMEOUT_SECONDS)
+    server.terminate()
+    raise Exception("Model server did not become ready")
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    server.terminate()
+    server.wait()
+
+
+def encode_request(X: np.ndarray, protocol: str) -> bytes:
+    if protocol == 'binary':
+        return X.tobytes()
+    states = [dict(zip(predict_keys, row)) for row in X.tolist()]
+    return json.dumps(states if len(states) > 1 else states[0]).encode('utf-8')
+
+
+def request(c: socket.socket, X: np.ndarray, protocol: str) -> np.ndarray:
+    send_frame(c, encode_request(X, protocol))
+    if protocol == 'binary':
+        return np.frombuffer(recv_exact(c, recv_header(c)[0]), dtype=PREDICTION_DTYPE)
+    return np.array(json.loads(recv_message(c)), ndmin=1)
+
+
+def pipelined_requests(c: socket.socket, batch: Callable[[int], np.ndarray], start: int, count: int, protocol: str,
+                       depth: int) -> List[int]:
+    """Sends `count` requests with request IDs, keeping up to `depth` of them outstanding; returns the response times"""
+    start_times = {}
+    response_times_ns = []
+    next_id = start
+    while next_id < start + count or start_times:
+        while next_id < start + count and len(start_times) < depth:
+            payload = encode_request(batch(next_id), protocol)
+            start_times[next_id] = time_ns()
+            send_frame(c, REQUEST_ID.pack(next_id) + payload)
+            next_id += 1
+        reply = recv_exact(c, recv_header(c)[0])
+        response_times_ns.append(time_ns() - start_times.pop(REQUEST_ID.unpack_from(reply)[0]))
+    return response_times_ns
+
+
+def client_fn(socket_path: str, states: np.ndarray, batch_size: int, num_messages: int, num_warmup_messages: int,
+              protocol: str, transport: str, pipeline: int, offset: int, results: Queue) -> None:
+    c = create_client(socket_path)
+    shm: Optional[ShmClient] = None
+    try:
+        if transport == 'shm':
+            shm = ShmClient(c, predict_keys, max_rows=batch_size)
+        elif protocol == 'binary' or pipeline > 1:
+            send_control(c, 'hello', {'protocol': protocol, 'features': predict_keys, 'requestIds': pipeline > 1})
+            reply = json.loads(recv_message(c))
+            if not reply['ok']:
+                raise Exception(f"Handshake failed: {reply}")
+
+        def batch(i: int) -> np.ndarray:
+            start = (offset + i * batch_size) % len(states)
+            return np.take(states, range(start, start + batch_size), axis=0, mode='wrap')
+
+        def send(X: np.ndarray) -> np.ndarray:
+            return shm.predict(X) if shm is not None else request(c, X, protocol)
+
+        if shm is None and pipeline > 1:
+            pipelined_requests(c, batch, 0, num_warmup_messages, protocol, pipeline)
+            benchmark_start_time = time_ns()
+            response_times_ns = pipelined_requests(c, batch, num_warmup_messages, num_messages, protocol, pipeline)
+            results.put((benchmark_start_time, time_ns(), response_times_ns))
+            return
+
+        for i in range(num_warmup_messages):
+            send(batch(i))
+
+        response_times_ns = []
+        benchmark_start_time = time_ns()
+        for i in range(num_messages):
+            X = batch(i)
+            start_time = time_ns()
+            send(X)
+            response_times_ns.append(time_ns() - start_time)
+        results.put((benchmark_start_time, time_ns(), response_times_ns))
+    finally:
+        if shm is not None:
+            shm.close()
+        else:
+            c.close()
+
+
+def run_clients(socket_path: str, states: np.ndarray, clients: int, batch_size: int, num_messages: int,
+                num_warmup_messages: int, protocol: str, transport: str, pipeline: int) -> dict:
+    # the clients are not synchronized: a single-client server only serves the next client once the previous one
+    # disconnects, so throughput is measured from the first client's start to the last client's end
+    results = Queue()
+    processes = [
+        Process(target=client_fn, args=(socket_path, states, batch_size, num_messages, num_warmup_messages, protocol,
+                                        transport, pipeline, i * len(states) // clients, results))
+        for i in range(clients)
+    ]
+    for process in processes:
+        process.start()
+    client_results = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    response_times_ns = np.concatenate([np.array(times, dtype=np.int64) for _, _, times in client_results])
+    total_time_s = (max(end for _, end, _ in client_results) - min(start for start, _, _ in client_results)) / 1e9
+
+    return {
+        'requests': len(response_times_ns),
+        'throughputRequestsPerSecond': len(response_times_ns) / total_time_s,
+        'throughputStatesPerSecond': len(response_times_ns) * batch_size / total_time_s,
+        'latencyMs': {
+            'mean': float(np.mean(response_times_ns)) / 1e6,
+            'p50': float(np.percentile(response_times_ns, 50)) / 1e6,
+            'p99': float(np.percentile(response_times_ns, 99)) / 1e6,
+            'max': float(np.max(response_times_ns)) / 1e6,
+        },
+    }
+
+
+def run_real_benchmarks(args: Namespace) -> None:
+    states = load_states(args.states, 100_000)
+    server_args = shlex.split(args.server_args)
+    results = []
+    for model_path in args.models:
+        model_name = os.path.splitext(os.path.basename(model_path))[0]
+        server = start_server(args.socket_path, model_path, server_args)
+        try:
+            for clients in args.clients:
+                for batch_size in args.batch_sizes:
+                    result = {
+                        'model': model_name,
+                        'clients': clients,
+                        'batchSize': batch_size,
+                        'protocol': args.protocol,
+                        'transport': args.transport,
+                        'pipeline': args.pipeline,
+                        **run_clients(args.socket_path, states, clients, batch_size, args.num_messages,
+                                      args.warmup_messages, args.protocol, args.transport, args.pipeline),
+                    }
+                    latency = result['latencyMs']
+                    print(f"{model_name} clients={clients} batch={batch_size}: "
+                          f"{result['throughputStatesPerSecond']:.0f} states/s, "
+                          f"p50={latency['p50']:.3f}ms p99={latency['p99']:.3f}ms max={latency['max']:.3f}ms")
+                    results.append(result)
+        finally:
+            stop_server(server)
+
+    with open(args.results, 'w') as f:
+        json.dump({'serverArgs': server_args, 'numMessages': args.num_messages, 'results': results}, f, indent=4)
+    print(f"Results written to {args.results}")
+
+
+def result_key(result: dict):
+    # results written before the shared-memory transport and pipelining existed used the socket, one request at a time
+    return result['model'], result['clients'], result['batchSize'], result['protocol'], \
+        result.get('transport', 'socket'), result.get('pipeline', 1)
+
+
+def compare_results(old_path: str, new_path: str, threshold: float) -> bool:
+    """Prints the change of every benchmark present in both files, returns whether any of them regressed"""
+    with open(old_path) as f:
+        old_results = {result_key(r): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new_results = {result_key(r): r for r in json.load(f)['results']}
+
+    regressed = False
+    for key, new in new_results.items():
+        if key not in old_results:
+            continue
+        old = old_results[key]
+        throughput_change = new['throughputStatesPerSecond'] / old['throughputStatesPerSecond'] - 1
+        p99_change = new['latencyMs']['p99'] / old['latencyMs']['p99'] - 1
+        is_regression = throughput_change < -threshold or p99_change > threshold
+        regressed |= is_regression
+        print(f"{'REGRESSION ' if is_regression else ''}{key}: throughput {throughput_change * 100:+.1f}%, "
+              f"p99 {p99_change * 100:+.1f}%")
+    return regressed
+
+
 def create_client(socket_path: str):
     # wait for the server to start
     while not os.path.exists(socket_path):
@@ -0,0 +1,85 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+def model_fingerprint(model_path: str) -> str:
+    stat = os.stat(model_path)
+    return f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class PredictionCache:
+    """
+    Memoizes the predictions of a model, keyed on the exact feature vector of a state.
+    Behaves like the wrapped model (it has a predict method), so it can be used wherever the model is used.
+    Holds at most `max_entries` predictions, evicting the least recently used one when full.
+    """
+
+    def __init__(self, model, max_entries: int):
+        self.model = model
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def predict(self, X) -> np.ndarray:
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        keys = [row.tobytes() for row in X]
+        y = np.empty(len(X))
+        missing = []
+        for i, key in enumerate(keys):
+            value = self.entries.get(key)
+            if value is None:
+                missing.append(i)
+            else:
+                self.entries.move_to_end(key)
+                y[i] = value
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            predictions = np.asarray(self.model.predict(X[missing])).reshape(len(missing), -1)[:, 0]
+            y[missing] = predictions
+            for i, value in zip(missing, predictions):
+                self.put(keys[i], float(value))
+        return y
+
+    def put(self, key: bytes, value: float) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'maxEntries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def save(self, path: str, fingerprint: str) -> None:
+        """Writes the entries (least recently used first) to an .npz file"""
+        if self.entries:
+            features = np.frombuffer(b''.join(self.entries.keys()), dtype=np.float64).reshape(len(self.entries), -1)
+        else:
+            features = np.empty((0, 0))
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, features=features, predictions=np.fromiter(self.entries.values(), dtype=np.float64),
+                 fingerprint=np.array(fingerprint))
+        os.replace(tmp_path, path)
+
+    def load(self, path: str, fingerprint: str) -> bool:
+        """Loads the entries saved for the same model, returns whether anything was loaded"""
+        if not os.path.exists(path):
+            return False
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['fingerprint']) != fingerprint:
+                print(f"Ignoring cache file '{path}', it was saved for a different model")
+                return False
+            for row, value in zip(data['features'], data['predictions']):
+                self.put(np.ascontiguousarray(row).tobytes(), float(value))
+        return True
@@ -11,6 +11,8 @@ instances_dir=""
 fms_dir=""
 python_server_file=""
 model_file=""
+fallback_model_file=""
+latency_budget_ms=""
 output_dir=""
 venv_dir=""
 exploration_type="xd"
@@ -21,7 +23,10 @@ log=0
 rank=-1
 N=-1
 run_idx=0
+shared_server=0
+shared_socket=""
 socket_pids=()
+run_pids=()
 
 assert_dir() {
   if [ ! -d "$1" ]; then
@@ -38,12 +43,19 @@ assert_file() {
 }
 
 re_number="^\-?[0-9]+$"
+re_decimal="^[0-9]+(\.[0-9]+)?$|^\.[0-9]+$"
 assert_number() {
   if ! [[ $1 =~ $re_number ]] ; then
     echo "Error: '$1' is NaN"
     exit 1
   fi
 }
+assert_decimal() {
+  if ! [[ $1 =~ $re_decimal ]] ; then
+    echo "Error: '$1' is not a non-negative decimal number"
+    exit 1
+  fi
+}
 
 assert_in_array() {
   needle=""${1,,}
@@ -73,6 +85,9 @@ print_help() {
 [-l log] \
 [-r rank] \
 [-n workers] \
+[-c] \
+[-y fallback_model_file] \
+[-u latency_budget_ms] \
 "
   echo "  -i instances_dir (required): directory containing the instances"
   echo "  -f fms_dir (required): directory containing the fms-scheduler"
@@ -89,10 +104,13 @@ print_help() {
   echo "     Instead, you can also use the SLURM_PROCID environment variable"
   echo "  -n workers: number of workers to use (default: number of cores)"
   echo "     Instead, you can also use the SLURM_NTASKS environment variable"
+  echo "  -c shared server: serve all scheduler runs from one concurrent (async) model server"
+  echo "  -y fallback_model_file: cheap model joblib file that answers when the model misses the latency budget"
+  echo "  -u latency_budget_ms: latency budget of the model in milliseconds, e.g. 0.5 (with -y, default: 5)"
   exit 0
 }
 
-while getopts "i:f:v:p:x:o:e:t:sm:lr:n:h" opt; do
+while getopts "i:f:v:p:x:o:e:t:sm:lr:n:cy:u:h" opt; do
   case ${opt} in
     i )
       instances_dir=${OPTARG}
@@ -145,6 +163,17 @@ while getopts "i:f:v:p:x:o:e:t:sm:lr:n:h" opt; do
       N=${OPTARG}
       assert_number "$N"
       ;;
+    c )
+      shared_server=1
+      ;;
+    y )
+      fallback_model_file=${OPTARG}
+      assert_file "$fallback_model_file" "Fallback model"
+      ;;
+    u )
+      latency_budget_ms=${OPTARG}
+      assert_decimal "$latency_budget_ms"
+      ;;
     * )
       print_help
       ;;
@@ -203,6 +232,34 @@ log() {
   echo "[$((i + 1))/$total] $1"
 }
 
+# starts a model server in the background and waits until it reports being ready
+start_server() {
+  _socket=$1
+  _ready_file="$_socket.ready"
+  rm -f "$_ready_file"
+  _log_name="model-server-$(basename "$_socket" .s)"
+  _cascade_args=()
+  if [ -n "$fallback_model_file" ]; then
+    _cascade_args=(--fallback-model "$fallback_model_file" --latency-budget-ms "${latency_budget_ms:-5}")
+  fi
+  "$venv_dir/bin/python3" -u "$python_server_file" "$_socket" "$model_file" --ready-file "$_ready_file" \
+    --stats-file "$output_dir/$_log_name.stats.json" "${_cascade_args[@]}" "${@:2}" > "$output_dir/$_log_name.log" 2>&1 &
+  server_pid=$!
+  socket_pids+=($server_pid)
+  for _ in $(seq 1200); do
+    if [ -f "$_ready_file" ]; then
+      return 0
+    fi
+    if ! kill -0 "$server_pid" 2>/dev/null; then
+      echo "Error: model server for '$_socket' exited before it was ready"
+      return 1
+    fi
+    sleep 0.1
+  done
+  echo "Error: model server for '$_socket' was not ready after 120 seconds"
+  return 1
+}
+
 runCanonFlowShop() {
   root_folder="$instances_dir/$FLOWSHOPS_CANON"
   folder_names=$()
@@ -224,6 +281,7 @@ runCanonFlowShop() {
         run_app "$input_file" "$rel_output_dir" "fixedorder" "$run_idx"
       else
         run_app "$input_file" "$rel_output_dir" "fixedorder" "$run_idx" &
+        run_pids+=($!)
       fi
       run_idx=$((run_idx + 1))
       i=$((i + 1))
@@ -249,10 +307,15 @@ run_app() {
 
   extra=""
   if [ "$exploration_type" = "bestml" ]; then
-    socket="/tmp/socket-$(basename "$model_file" .joblib)-$rank-$_run_idx.s"
-    "$venv_dir/bin/python3" -u "$python_server_file" "$socket" "$model_file" > "$output_dir/model-server-$(basename "$socket" .s).log" 2>&1 &
-    socket_pids+=($!)
-    sleep 10
+    if [ "$shared_server" = 1 ]; then
+      socket="$shared_socket"
+    else
+      socket="/tmp/socket-$(basename "$model_file" .joblib)-$rank-$_run_idx.s"
+      if ! start_server "$socket"; then
+        log "Skipping $_rel_output_dir"
+        return
+      fi
+    fi
     extra="$extra --socket $socket"
   fi
   if [ "$output_state_data" = 1 ]; then
@@ -287,6 +350,9 @@ $extra \
   else
     log "Process crashed with exit code $_ret_code"
   fi
+  if [ "$exploration_type" = "bestml" ] && [ "$shared_server" = 0 ]; then
+    kill "$server_pid"
+  fi
 }
 
 run() {
@@ -308,6 +374,7 @@ run() {
       run_app "$input_file" "$rel_output_dir" "$shop_type_short" "$run_idx"
     else
       run_app "$input_file" "$rel_output_dir" "$shop_type_short" "$run_idx" &
+      run_pids+=($!)
     fi
     run_idx=$((run_idx + 1))
     i=$((i + 1))
@@ -334,6 +401,13 @@ for shop_type in "${SHOP_TYPES[@]}"; do
   done
 done
 
+if [ "$exploration_type" = "bestml" ] && [ "$shared_server" = 1 ]; then
+  shared_socket="/tmp/socket-$(basename "$model_file" .joblib)-$rank-shared.s"
+  if ! start_server "$shared_socket" --mode async; then
+    exit 1
+  fi
+fi
+
 runCanonFlowShop
 for shop_type in "${SHOP_TYPES[@]}"; do
   if [ "$shop_type" = "FlowShops" ]; then
@@ -347,7 +421,11 @@ for shop_type in "${SHOP_TYPES[@]}"; do
 done
 
 if [ "$exploration_type" = "bestml" ]; then
+  # the shared server must outlive every scheduler run that uses it
+  for pid in "${run_pids[@]}"; do
+    wait "$pid"
+  done
   for pid in "${socket_pids[@]}"; do
-    kill -9 "$pid"
+    kill "$pid"
   done
 fi
@@ -0,0 +1,202 @@
+"""
+Shared-memory ring-buffer transport for the model server.
+
+After a `shm` control message on the socket, the server creates a `multiprocessing.shared_memory` block and the
+socket only carries wake-up bytes from then on. The block consists of a header followed by `slots` slots:
+
+    offset 0     uint32 magic, version, slots, maxRows, width
+    offset 64    uint32 serverWaiting (1 while the server is blocked on the socket)
+    offset 128   uint32 clientWaiting (1 while the client is blocked on the socket)
+    offset 192   slot 0, slot 1, ... (each slotSize bytes, 64-byte aligned)
+
+    slot:  uint32 state (0: empty, 1: request, 2: done), uint32 rows,
+           float64 features[maxRows][width], int64 predictions[maxRows]
+
+The client uses the slots in order: it writes the features and rows of a request, then sets the state to request.
+The server predicts every consecutive request it finds at once, writes the predictions and sets the states to done;
+the client reads the predictions and sets the state back to empty. A side that has nothing to do spins for a while,
+then sets its waiting flag and blocks on the socket; the other side sends a wake-up byte when it sees the flag.
+As the flag and the state are plain memory (no fences), a wake-up can in rare cases be missed, so blocking uses a
+short timeout.
+"""
+import json
+import select
+import socket
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, List, Optional
+
+import numpy as np
+
+MAGIC = 0x4d53524e  # 'MSRN'
+VERSION = 1
+HEADER = struct.Struct('5I')
+SERVER_WAITING_OFFSET = 64
+CLIENT_WAITING_OFFSET = 128
+SLOTS_OFFSET = 192
+ALIGNMENT = 64
+
+EMPTY = 0
+REQUEST = 1
+DONE = 2
+
+DEFAULT_SPIN_US = 100
+BLOCK_TIMEOUT_SECONDS = 0.001
+
+
+class ShmRing:
+    def __init__(self, shm: shared_memory.SharedMemory, slots: int, max_rows: int, width: int):
+        self.shm = shm
+        self.slots = slots
+        self.max_rows = max_rows
+        self.width = width
+        features_size = max_rows * width * 8
+        self.slot_size = -(-(8 + features_size + max_rows * 8) // ALIGNMENT) * ALIGNMENT
+
+        buf = shm.buf
+        self.server_waiting = np.ndarray((1,), dtype=np.uint32, buffer=buf, offset=SERVER_WAITING_OFFSET)
+        self.client_waiting = np.ndarray((1,), dtype=np.uint32, buffer=buf, offset=CLIENT_WAITING_OFFSET)
+        self.states = np.ndarray((slots,), dtype=np.uint32, buffer=buf, offset=SLOTS_OFFSET, strides=(self.slot_size,))
+        self.rows = np.ndarray((slots,), dtype=np.uint32, buffer=buf, offset=SLOTS_OFFSET + 4,
+                               strides=(self.slot_size,))
+        self.features = np.ndarray((slots, max_rows, width), dtype=np.float64, buffer=buf, offset=SLOTS_OFFSET + 8,
+                                   strides=(self.slot_size, width * 8, 8))
+        self.predictions = np.ndarray((slots, max_rows), dtype=np.int64, buffer=buf,
+                                      offset=SLOTS_OFFSET + 8 + features_size, strides=(self.slot_size, 8))
+
+    @staticmethod
+    def size(slots: int, max_rows: int, width: int) -> int:
+        slot_size = -(-(8 + max_rows * width * 8 + max_rows * 8) // ALIGNMENT) * ALIGNMENT
+        return SLOTS_OFFSET + slots * slot_size
+
+    @classmethod
+    def create(cls, slots: int, max_rows: int, width: int) -> 'ShmRing':
+        shm = shared_memory.SharedMemory(create=True, size=cls.size(slots, max_rows, width))
+        HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, slots, max_rows, width)
+        return cls(shm, slots, max_rows, width)
+
+    @classmethod
+    def attach(cls, name: str) -> 'ShmRing':
+        shm = shared_memory.SharedMemory(name=name)
+        # the server owns (and unlinks) the block, keep this process' resource tracker from unlinking it as well
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        magic, version, slots, max_rows, width = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise Exception(f"Shared memory block '{name}' is not a version {VERSION} model server ring")
+        return cls(shm, slots, max_rows, width)
+
+    def close(self, unlink: bool = False) -> None:
+        # drop the views before closing, the buffer cannot be released while they exist
+        self.server_waiting = self.client_waiting = self.states = self.rows = self.features = self.predictions = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def wait_for_state(ring: ShmRing, slot: int, state: int, waiting: np.ndarray, c: socket.socket,
+                   spin_s: float) -> bool:
+    """Spins, then blocks on the socket until the slot has the state. Returns False if the peer disconnected."""
+    states = ring.states
+    if states[slot] == state:
+        return True
+    deadline = time.perf_counter() + spin_s
+    while time.perf_counter() < deadline:
+        if states[slot] == state:
+            return True
+    while True:
+        waiting[0] = 1
+        if states[slot] == state:
+            waiting[0] = 0
+            return True
+        readable, _, _ = select.select([c], [], [], BLOCK_TIMEOUT_SECONDS)
+        waiting[0] = 0
+        if readable and not c.recv(4096):
+            return False
+        if states[slot] == state:
+            return True
+
+
+def wake(waiting: np.ndarray, c: socket.socket) -> None:
+    if waiting[0]:
+        c.send(b'\0')
+
+
+def serve_ring(c: socket.socket, ring: ShmRing, predict: Callable[[np.ndarray], np.ndarray],
+               reorder: Callable[[np.ndarray], np.ndarray], on_batch: Callable[[int, int, int], None],
+               spin_us: int = DEFAULT_SPIN_US) -> None:
+    """
+    Serves requests from the ring until the client disconnects.
+    Consecutive requests that are already waiting are predicted in one call; on_batch gets the number of requests,
+    the number of states and the predict time in ns of every batch.
+    """
+    slot = 0
+    spin_s = spin_us / 1e6
+    while wait_for_state(ring, slot, REQUEST, ring.server_waiting, c, spin_s):
+        batch = [slot]
+        while len(batch) < ring.slots and ring.states[(batch[-1] + 1) % ring.slots] == REQUEST:
+            batch.append((batch[-1] + 1) % ring.slots)
+
+        rows = [int(ring.rows[i]) for i in batch]
+        X = np.concatenate([ring.features[i, :n] for i, n in zip(batch, rows)])
+        t_start = time.perf_counter_ns()
+        y = predict(reorder(X)).astype(np.int64)
+        on_batch(len(batch), len(y), time.perf_counter_ns() - t_start)
+
+        offset = 0
+        for i, n in zip(batch, rows):
+            ring.predictions[i, :n] = y[offset:offset + n]
+            ring.states[i] = DONE
+            offset += n
+        wake(ring.client_waiting, c)
+        slot = (batch[-1] + 1) % ring.slots
+
+
+class ShmClient:
+    """
+    Client side of the transport, used by the benchmark (the scheduler implements the same layout).
+    submit/result allow several requests to be outstanding, predict sends one request and waits for it.
+    """
+
+    def __init__(self, c: socket.socket, features: List[str], slots: int = 64, max_rows: int = 64,
+                 spin_us: int = DEFAULT_SPIN_US):
+        # imported here, the model server itself imports this module
+        from model_server import recv_message, send_control
+
+        self.c = c
+        self.spin_s = spin_us / 1e6
+        send_control(c, 'shm', {'features': features, 'slots': slots, 'maxRows': max_rows})
+        reply = json.loads(recv_message(c))
+        if not reply['ok']:
+            raise Exception(f"Shared memory handshake failed: {reply}")
+        self.ring = ShmRing.attach(reply['name'])
+        self.next_slot = 0
+
+    def submit(self, X: np.ndarray) -> int:
+        ring = self.ring
+        slot = self.next_slot
+        if ring.states[slot] != EMPTY:
+            raise Exception("All ring slots are in use, collect results before submitting more requests")
+        if len(X) > ring.max_rows:
+            raise Exception(f"Request of {len(X)} states does not fit in a slot of {ring.max_rows}")
+        ring.features[slot, :len(X)] = X
+        ring.rows[slot] = len(X)
+        ring.states[slot] = REQUEST
+        wake(ring.server_waiting, self.c)
+        self.next_slot = (slot + 1) % ring.slots
+        return slot
+
+    def result(self, slot: int) -> Optional[np.ndarray]:
+        ring = self.ring
+        if not wait_for_state(ring, slot, DONE, ring.client_waiting, self.c, self.spin_s):
+            return None
+        y = ring.predictions[slot, :ring.rows[slot]].copy()
+        ring.states[slot] = EMPTY
+        return y
+
+    def predict(self, X: np.ndarray) -> Optional[np.ndarray]:
+        return self.result(self.submit(X))
+
+    def close(self) -> None:
+        self.ring.close()
+        self.c.close()
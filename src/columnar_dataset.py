@@ -0,0 +1,210 @@
+import argparse
+import itertools
+import json
+import os
+import pathlib
+from typing import Dict, Iterator, List, Union
+
+import numpy as np
+
+from models import x_keys, y_key
+from utils import assert_empty
+
+# A columnar dataset is a folder with one .npy file per column and a meta.json, written last, describing them:
+#   X.npy             float64 [rows, len(x_keys)]
+#   y.npy             float64 [rows]
+#   vertexDepth.npy   int64 [rows]
+#   relPath.npy       int32 [rows], index into meta['relPaths']
+#   problemName.npy   int32 [rows], index into meta['problemNames']
+# meta['yIntegral'] records whether every y_key value in the jsonl data was an integer (y.npy is float64 regardless).
+# The columns are loaded memory-mapped, so loading costs next to nothing and processes share the page cache.
+META_FILE = 'meta.json'
+
+
+class ColumnarDataset:
+    """The x_keys features, y_key targets and group columns of a dataset as (memory-mapped) NumPy arrays"""
+
+    def __init__(self, X: np.ndarray, y: np.ndarray, depth: np.ndarray, rel_path: np.ndarray,
+                 problem_name: np.ndarray, rel_paths: List[str], problem_names: List[str], y_integral: bool = False):
+        self.X = X
+        self.y = y
+        self.depth = depth
+        self.rel_path = rel_path
+        self.problem_name = problem_name
+        self.rel_paths = rel_paths
+        self.problem_names = problem_names
+        # whether the targets were integers in the jsonl data, so they can be reported as such
+        self.y_integral = y_integral
+
+    def __len__(self) -> int:
+        return len(self.y)
+
+    def group(self, i: int):
+        """The (relPath, problemName) of row i"""
+        return self.rel_paths[self.rel_path[i]], self.problem_names[self.problem_name[i]]
+
+
+def is_columnar(path: pathlib.Path) -> bool:
+    return (pathlib.Path(path) / META_FILE).exists()
+
+
+def dataset_path(folder: pathlib.Path, name: str) -> pathlib.Path:
+    """The columnar dataset `name` in the folder if it was converted, else `name`.jsonl"""
+    columnar = folder / name
+    return columnar if is_columnar(columnar) else folder / f'{name}.jsonl'
+
+
+def parse_row(data: dict, codes: Dict[str, Dict[str, int]]):
+    for x_key in x_keys:
+        if x_key not in data:
+            raise Exception(f"Input key '{x_key}' not in json data")
+    if y_key not in data:
+        raise Exception(f"Output key '{y_key}' not in json data")
+    rel_path = codes['relPath'].setdefault(data.get('relPath', ''), len(codes['relPath']))
+    problem_name = codes['problemName'].setdefault(data.get('problemName', ''), len(codes['problemName']))
+    return [data[key] for key in x_keys], data[y_key], data['vertexDepth'], rel_path, problem_name
+
+
+def is_integral(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def load_jsonl(path: pathlib.Path) -> ColumnarDataset:
+    codes = {'relPath': {}, 'problemName': {}}
+    with open(path, 'r') as f:
+        rows = [parse_row(json.loads(line), codes) for line in f]
+    return rows_dataset(rows, codes)
+
+
+def rows_dataset(rows: list, codes: Dict[str, Dict[str, int]]) -> ColumnarDataset:
+    X, y, depth, rel_path, problem_name = zip(*rows) if rows else ([], [], [], [], [])
+    y_integral = all(is_integral(value) for value in y)
+    return ColumnarDataset(
+        np.array(X, dtype=np.float64).reshape(len(rows), len(x_keys)),
+        np.array(y, dtype=np.float64),
+        np.array(depth, dtype=np.int64),
+        np.array(rel_path, dtype=np.int32),
+        np.array(problem_name, dtype=np.int32),
+        list(codes['relPath']),
+        list(codes['problemName']),
+        y_integral,
+    )
+
+
+def load_columnar(path: pathlib.Path) -> ColumnarDataset:
+    with open(path / META_FILE) as f:
+        meta = json.load(f)
+    if meta['xKeys'] != x_keys or meta['yKey'] != y_key:
+        raise Exception(f"Dataset '{path}' was converted with different features, convert it again")
+
+    def column(name: str) -> np.ndarray:
+        return np.load(path / f'{name}.npy', mmap_mode='r')
+
+    return ColumnarDataset(column('X'), column('y'), column('vertexDepth'), column('relPath'), column('problemName'),
+                           meta['relPaths'], meta['problemNames'], meta.get('yIntegral', False))
+
+
+def iter_chunks(source: Union[pathlib.Path, ColumnarDataset], chunk_size: int) -> Iterator[ColumnarDataset]:
+    """
+    The dataset (a path or a loaded dataset) in blocks of chunk_size rows, a jsonl file is read one block at a time.
+    The group codes are those of the whole dataset, so the names of the last block cover all earlier blocks.
+    """
+    if isinstance(source, ColumnarDataset) or is_columnar(source):
+        dataset = source if isinstance(source, ColumnarDataset) else load_columnar(pathlib.Path(source))
+        for start in range(0, len(dataset), chunk_size):
+            end = start + chunk_size
+            yield ColumnarDataset(dataset.X[start:end], dataset.y[start:end], dataset.depth[start:end],
+                                  dataset.rel_path[start:end], dataset.problem_name[start:end], dataset.rel_paths,
+                                  dataset.problem_names, dataset.y_integral)
+        return
+
+    codes = {'relPath': {}, 'problemName': {}}
+    with open(source, 'r') as f:
+        while True:
+            rows = [parse_row(json.loads(line), codes) for line in itertools.islice(f, chunk_size)]
+            if not rows:
+                return
+            yield rows_dataset(rows, codes)
+
+
+def load_dataset(path: pathlib.Path) -> ColumnarDataset:
+    """Loads a columnar dataset folder (memory-mapped) or parses a jsonl file"""
+    path = pathlib.Path(path)
+    if is_columnar(path):
+        return load_columnar(path)
+    return load_jsonl(path)
+
+
+def convert(input: pathlib.Path, output: pathlib.Path):
+    """Converts a jsonl file into a columnar dataset folder, streaming the rows straight into the column files"""
+    with open(input, 'r') as f:
+        rows = sum(1 for _ in f)
+
+    def column(name: str, dtype, shape=()) -> np.ndarray:
+        return np.lib.format.open_memmap(output / f'{name}.npy', mode='w+', dtype=dtype, shape=(rows, *shape))
+
+    X = column('X', np.float64, (len(x_keys),))
+    y = column('y', np.float64)
+    depth = column('vertexDepth', np.int64)
+    rel_path = column('relPath', np.int32)
+    problem_name = column('problemName', np.int32)
+    codes = {'relPath': {}, 'problemName': {}}
+    y_integral = True
+    with open(input, 'r') as f:
+        for i, line in enumerate(f):
+            X[i], y_value, depth[i], rel_path[i], problem_name[i] = parse_row(json.loads(line), codes)
+            y[i] = y_value
+            y_integral = y_integral and is_integral(y_value)
+    for array in (X, y, depth, rel_path, problem_name):
+        array.flush()
+
+    with open(output / META_FILE, 'w') as f:
+        json.dump({
+            'rows': rows,
+            'xKeys': x_keys,
+            'yKey': y_key,
+            'yIntegral': y_integral,
+            'relPaths': list(codes['relPath']),
+            'problemNames': list(codes['problemName']),
+        }, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Columnar Dataset Converter',
+        description='Converts jsonl data into memory-mappable columnar datasets (one folder per file)',
+    )
+    parser.add_argument(
+        '-i',
+        '--input',
+        required=True,
+        nargs='+',
+        type=pathlib.Path,
+        help='The jsonl files to convert (e.g. train.jsonl test.jsonl)',
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        required=True,
+        type=pathlib.Path,
+        help='The folder to write the datasets to, each in a folder named after its input file (e.g. train/)',
+    )
+    parser.add_argument(
+        '-c',
+        '--clean',
+        action=argparse.BooleanOptionalAction,
+        help='Clean the output datasets before writing to them',
+    )
+    args = parser.parse_args()
+
+    for input in args.input:
+        if not os.path.exists(input):
+            print(f"Input file '{input}' does not exist")
+            exit(1)
+    for input in args.input:
+        output = args.output / input.stem
+        assert_empty(output, args.clean)
+        if not output.exists():
+            os.makedirs(output)
+        convert(input, output)
+        print(f"Converted {input} to {output}")
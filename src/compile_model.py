@@ -0,0 +1,75 @@
+import argparse
+import pathlib
+
+import joblib
+import numpy as np
+
+from compiled_models import MAPPED_SUFFIX, CompiledModel, compile_model, save_mapped
+from train import get_dataset
+from utils import assert_empty
+
+
+def check(model, compiled: CompiledModel, test_path: pathlib.Path, limit: int):
+    X, _ = get_dataset(test_path)
+    X = np.asarray(X[:limit], dtype=np.float64)
+    expected = np.asarray(model.predict(X), dtype=np.float64).reshape(len(X), -1)[:, 0]
+    actual = compiled.predict(X)
+    print(f"Max absolute difference: {np.max(np.abs(expected - actual), initial=0)}")
+    print(f"Identical integer predictions: {np.mean(expected.astype(np.int64) == actual.astype(np.int64)) * 100}%")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Model Compiler',
+        description='Exports a trained model to a lean NumPy inference model without sklearn validation overhead',
+    )
+    parser.add_argument(
+        '-m',
+        '--model',
+        required=True,
+        type=pathlib.Path,
+        help='The trained model (.joblib) to compile',
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        required=True,
+        type=pathlib.Path,
+        help=f'The file to write the compiled model to, memory-mappable if it ends with {MAPPED_SUFFIX} (else joblib)',
+    )
+    parser.add_argument(
+        '-t',
+        '--test',
+        type=pathlib.Path,
+        help='A test jsonl file to compare the predictions of the compiled and original model on',
+    )
+    parser.add_argument(
+        '-n',
+        '--check-rows',
+        type=int,
+        default=10_000,
+        help='The amount of test rows to compare',
+    )
+    parser.add_argument(
+        '-c',
+        '--clean',
+        action=argparse.BooleanOptionalAction,
+        help='Clean the output model before writing to it',
+    )
+    args = parser.parse_args()
+
+    if not args.model.exists():
+        print(f"Model file '{args.model}' does not exist")
+        exit(1)
+    assert_empty(args.output, args.clean, 'file')
+
+    model = joblib.load(args.model)
+    compiled = compile_model(model)
+    if args.output.suffix == MAPPED_SUFFIX:
+        save_mapped(compiled, args.output)
+    else:
+        joblib.dump(compiled, args.output)
+    print(f"Compiled {type(model).__name__} to {args.output}")
+
+    if args.test is not None:
+        check(model, compiled, args.test, args.check_rows)
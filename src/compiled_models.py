@@ -0,0 +1,262 @@
+import json
+import os
+import pathlib
+import struct
+from typing import Dict
+
+import joblib
+import numpy as np
+
+
+class CompiledModel:
+    """
+    A fitted model reduced to plain NumPy arrays, with a predict that skips all of sklearn's input validation.
+    Predictions are returned as a flat float64 array, like the single-output sklearn regressors do.
+    """
+    kind = ''
+
+    def __init__(self, params: dict, arrays: Dict[str, np.ndarray]):
+        self.params = params
+        self.arrays = arrays
+
+    @classmethod
+    def from_sklearn(cls, model) -> 'CompiledModel':
+        raise NotImplementedError()
+
+    def predict(self, X) -> np.ndarray:
+        raise NotImplementedError()
+
+
+class CompiledDTR(CompiledModel):
+    """DecisionTreeRegressor as flat node arrays. Leaves point to themselves so every row can take max_depth steps."""
+    kind = 'DTR'
+
+    @classmethod
+    def from_sklearn(cls, model) -> 'CompiledDTR':
+        tree = model.tree_
+        nodes = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+        return cls({'maxDepth': int(tree.max_depth)}, {
+            'left': np.where(is_leaf, nodes, tree.children_left).astype(np.intp),
+            'right': np.where(is_leaf, nodes, tree.children_right).astype(np.intp),
+            'feature': np.where(is_leaf, 0, tree.feature).astype(np.intp),
+            'threshold': tree.threshold.astype(np.float64),
+            'value': tree.value[:, 0, 0].astype(np.float64),
+        })
+
+    def predict(self, X) -> np.ndarray:
+        # sklearn compares float32 features against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        left, right, feature, threshold = (self.arrays[k] for k in ('left', 'right', 'feature', 'threshold'))
+        if len(X) == 1:
+            x = X[0]
+            node = 0
+            while left[node] != node:
+                node = left[node] if x[feature[node]] <= threshold[node] else right[node]
+            return self.arrays['value'][[node]]
+
+        rows = np.arange(len(X))
+        node = np.zeros(len(X), dtype=np.intp)
+        for _ in range(self.params['maxDepth']):
+            node = np.where(X[rows, feature[node]] <= threshold[node], left[node], right[node])
+        return self.arrays['value'][node]
+
+
+class CompiledMLPR(CompiledModel):
+    """MLPRegressor as a chain of matmuls"""
+    kind = 'MLPR'
+    activations = {
+        'identity': lambda a: a,
+        'logistic': lambda a: 1 / (1 + np.exp(-a)),
+        'tanh': np.tanh,
+        'relu': lambda a: np.maximum(a, 0),
+    }
+
+    @classmethod
+    def from_sklearn(cls, model) -> 'CompiledMLPR':
+        if model.activation not in cls.activations or model.out_activation_ != 'identity':
+            raise ValueError(f"Unsupported MLPR activation '{model.activation}' / '{model.out_activation_}'")
+        arrays = {}
+        for i, (coef, intercept) in enumerate(zip(model.coefs_, model.intercepts_)):
+            arrays[f'coef{i}'] = np.ascontiguousarray(coef, dtype=np.float64)
+            arrays[f'intercept{i}'] = np.ascontiguousarray(intercept, dtype=np.float64)
+        return cls({'layers': len(model.coefs_), 'activation': model.activation}, arrays)
+
+    def predict(self, X) -> np.ndarray:
+        a = np.asarray(X, dtype=np.float64)
+        activation = self.activations[self.params['activation']]
+        layers = self.params['layers']
+        for i in range(layers):
+            a = a @ self.arrays[f'coef{i}'] + self.arrays[f'intercept{i}']
+            if i < layers - 1:
+                a = activation(a)
+        return a[:, 0]
+
+
+class CompiledPLSR(CompiledModel):
+    """
+    PLSRegression as a single affine map.
+    PLS predictions are affine in X, so the map is read off the model by predicting the origin and the unit vectors,
+    which works regardless of how the sklearn version lays out its coefficients.
+    """
+    kind = 'PLSR'
+
+    @classmethod
+    def from_sklearn(cls, model) -> 'CompiledPLSR':
+        n = model.n_features_in_
+        points = np.vstack([np.zeros((1, n)), np.eye(n)])
+        predictions = np.asarray(model.predict(points), dtype=np.float64).reshape(n + 1, -1)[:, 0]
+        return cls({}, {
+            'coef': predictions[1:] - predictions[0],
+            'intercept': predictions[:1].copy(),
+        })
+
+    def predict(self, X) -> np.ndarray:
+        return np.asarray(X, dtype=np.float64) @ self.arrays['coef'] + self.arrays['intercept'][0]
+
+
+class CompiledKNNR(CompiledModel):
+    """
+    KNeighborsRegressor as a brute-force distance search over the training rows.
+    Neighbors at equal distance may be picked differently than sklearn does (its own tree and brute-force
+    searches disagree on those ties as well).
+    """
+    kind = 'KNNR'
+    # distance matrix entries computed at once, bounds the memory used by a batch
+    max_chunk_elements = 1 << 24
+
+    @classmethod
+    def from_sklearn(cls, model) -> 'CompiledKNNR':
+        metric = model.effective_metric_
+        p = {'euclidean': 2, 'manhattan': 1, 'chebyshev': np.inf}.get(metric)
+        if metric == 'minkowski' and model.effective_metric_params_.get('w') is None:
+            p = model.effective_metric_params_['p']
+        if p is None:
+            raise ValueError(f"Unsupported KNNR metric '{metric}'")
+        if model.weights not in ('uniform', 'distance'):
+            raise ValueError(f"Unsupported KNNR weights '{model.weights}'")
+        fit_X = np.ascontiguousarray(model._fit_X, dtype=np.float64)
+        return cls({'nNeighbors': int(model.n_neighbors), 'weights': model.weights, 'p': float(p)}, {
+            'fitX': fit_X,
+            'fitY': np.asarray(model._y, dtype=np.float64).reshape(len(fit_X), -1)[:, 0].copy(),
+            'fitNorms': np.einsum('ij,ij->i', fit_X, fit_X),
+        })
+
+    def ranking_distances(self, X: np.ndarray) -> np.ndarray:
+        """Distances to every training row, or a monotonic function of them, to select the neighbors with"""
+        fit_X = self.arrays['fitX']
+        p = self.params['p']
+        if p == 2:
+            # squared distances via |x|^2 - 2 x.f + |f|^2
+            d = np.einsum('ij,ij->i', X, X)[:, None] - 2 * (X @ fit_X.T) + self.arrays['fitNorms']
+            return np.maximum(d, 0, out=d)
+        d = np.zeros((len(X), len(fit_X)))
+        for j in range(X.shape[1]):
+            diff = np.abs(X[:, j, None] - fit_X[:, j])
+            if p == np.inf:
+                np.maximum(d, diff, out=d)
+            else:
+                d += diff if p == 1 else diff ** p
+        return d
+
+    def distances(self, X: np.ndarray, neighbors: np.ndarray) -> np.ndarray:
+        """Exact distances from every row of X to its selected neighbors"""
+        diff = np.abs(X[:, None, :] - self.arrays['fitX'][neighbors])
+        p = self.params['p']
+        if p == np.inf:
+            return diff.max(axis=2)
+        if p == 1:
+            return diff.sum(axis=2)
+        return (diff ** p).sum(axis=2) ** (1 / p)
+
+    def predict(self, X) -> np.ndarray:
+        X = np.asarray(X, dtype=np.float64)
+        k = self.params['nNeighbors']
+        chunk = max(1, self.max_chunk_elements // len(self.arrays['fitX']))
+        y = np.empty(len(X))
+        for start in range(0, len(X), chunk):
+            X_chunk = X[start:start + chunk]
+            d = self.ranking_distances(X_chunk)
+            neighbors = np.argpartition(d, k - 1, axis=1)[:, :k] if k < d.shape[1] else np.argsort(d, axis=1)
+            neighbor_y = self.arrays['fitY'][neighbors]
+            if self.params['weights'] == 'uniform':
+                y[start:start + chunk] = neighbor_y.mean(axis=1)
+                continue
+
+            # like sklearn: neighbors at distance 0 get all the weight
+            with np.errstate(divide='ignore'):
+                weights = 1 / self.distances(X_chunk, neighbors)
+            inf_mask = np.isinf(weights)
+            inf_rows = inf_mask.any(axis=1)
+            weights[inf_rows] = inf_mask[inf_rows]
+            y[start:start + chunk] = (weights * neighbor_y).sum(axis=1) / weights.sum(axis=1)
+        return y
+
+
+compiled_models = {Model.kind: Model for Model in (CompiledDTR, CompiledMLPR, CompiledPLSR, CompiledKNNR)}
+sklearn_models = {
+    'DecisionTreeRegressor': CompiledDTR,
+    'MLPRegressor': CompiledMLPR,
+    'PLSRegression': CompiledPLSR,
+    'KNeighborsRegressor': CompiledKNNR,
+}
+
+
+def compile_model(model) -> CompiledModel:
+    name = type(model).__name__
+    if name not in sklearn_models:
+        raise ValueError(f"Model '{name}' cannot be compiled (supported: {list(sklearn_models.keys())})")
+    return sklearn_models[name].from_sklearn(model)
+
+
+# Mapped model files: MAPPED_MAGIC, the byte length of the JSON header, the JSON header
+# ({"kind", "params", "arrays": {name: {"dtype", "shape", "offset"}}}) and then every array as raw C-order bytes,
+# starting at an offset aligned to MAPPED_ALIGNMENT. Loading maps the file read-only, so processes loading the
+# same file share its page cache pages instead of each unpickling a private copy.
+MAPPED_SUFFIX = '.cmodel'
+MAPPED_MAGIC = b'CMODEL1\0'
+MAPPED_PREFIX = struct.Struct('<8sQ')
+MAPPED_ALIGNMENT = 64
+
+
+def save_mapped(model: CompiledModel, path: pathlib.Path) -> None:
+    arrays = {name: np.ascontiguousarray(array) for name, array in model.arrays.items()}
+    descriptors = {}
+    offset = 0
+    for name, array in arrays.items():
+        descriptors[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // MAPPED_ALIGNMENT) * MAPPED_ALIGNMENT
+    header = json.dumps({'kind': model.kind, 'params': model.params, 'arrays': descriptors}).encode('utf-8')
+    data_start = -(-(MAPPED_PREFIX.size + len(header)) // MAPPED_ALIGNMENT) * MAPPED_ALIGNMENT
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAPPED_PREFIX.pack(MAPPED_MAGIC, len(header)) + header)
+        for name, array in arrays.items():
+            f.seek(data_start + descriptors[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_mapped(path: pathlib.Path) -> CompiledModel:
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    magic, header_size = MAPPED_PREFIX.unpack_from(data)
+    if magic != MAPPED_MAGIC:
+        raise ValueError(f"'{path}' is not a mapped model file")
+    header = json.loads(bytes(data[MAPPED_PREFIX.size:MAPPED_PREFIX.size + header_size]))
+    data_start = -(-(MAPPED_PREFIX.size + header_size) // MAPPED_ALIGNMENT) * MAPPED_ALIGNMENT
+    arrays = {}
+    for name, descriptor in header['arrays'].items():
+        dtype = np.dtype(descriptor['dtype'])
+        shape = tuple(descriptor['shape'])
+        count = int(np.prod(shape, dtype=np.int64))
+        arrays[name] = np.frombuffer(data, dtype, count, data_start + descriptor['offset']).reshape(shape)
+    return compiled_models[header['kind']](header['params'], arrays)
+
+
+def load_model(path: pathlib.Path):
+    """Loads a mapped model (.cmodel) or a joblib model, which may be a fitted sklearn model or a compiled one"""
+    if str(path).endswith(MAPPED_SUFFIX):
+        return load_mapped(path)
+    return joblib.load(path)
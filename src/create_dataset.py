@@ -4,6 +4,7 @@ import json
 import os
 import pathlib
 
+from columnar_dataset import convert
 from utils import assert_empty
 
 if __name__ == '__main__':
@@ -38,6 +39,11 @@ if __name__ == '__main__':
         action=argparse.BooleanOptionalAction,
         help='Clean the output folder before writing to it',
     )
+    parser.add_argument(
+        '--columnar',
+        action=argparse.BooleanOptionalAction,
+        help='Also convert the train and test data into columnar datasets (train/ and test/ next to the jsonl files)',
+    )
     args = parser.parse_args()
 
     if not os.path.exists(args.input):
@@ -51,6 +57,9 @@ if __name__ == '__main__':
     output_test = args.output / 'test.jsonl'
     assert_empty(output_train, args.clean, 'file')
     assert_empty(output_test, args.clean, 'file')
+    if args.columnar:
+        for name in ('train', 'test'):
+            assert_empty(args.output / name, args.clean)
 
     test_set = set()
     with open(args.test) as csvfile:
@@ -64,3 +73,9 @@ if __name__ == '__main__':
                 f_test.write(line)
             else:
                 f_train.write(line)
+
+    if args.columnar:
+        for name, path in (('train', output_train), ('test', output_test)):
+            os.makedirs(args.output / name, exist_ok=True)
+            convert(path, args.output / name)
+            print(f"Converted {path} to {args.output / name}")
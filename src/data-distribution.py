@@ -4,7 +4,9 @@ from collections import defaultdict
 from pathlib import Path
 from matplotlib import pyplot as plt
 import pickle as pkl
-import json
+import numpy as np
+
+from columnar_dataset import load_dataset
 
 CACHE_DIR = "cache"
 
@@ -12,8 +14,9 @@ def main():
     os.makedirs(CACHE_DIR, exist_ok=True)
 
     parser = ArgumentParser()
-    parser.add_argument("-ts", "--test_file", type=Path, required=True, help="Path to test file")
-    parser.add_argument("-tr", "--train_file", type=Path, required=True, help="Path to train file")
+    parser.add_argument("-ts", "--test_file", type=Path, required=True, help="Path to test file or columnar dataset")
+    parser.add_argument("-tr", "--train_file", type=Path, required=True,
+                        help="Path to train file or columnar dataset")
     parser.add_argument("-f", "--force", action="store_true", help="Force overwrite cache")
     parser.add_argument("-p", "--plot-dir", type=Path, default=Path("plots"), help="Path to plot directory")
     args = parser.parse_args()
@@ -39,12 +42,11 @@ def main():
         ]
 
         for file_path, depth_dict, name in xd:
-            with file_path.open("r") as f:
-                for line in f:
-                    obj = json.loads(line)
-                    depth = obj["vertexDepth"]
+            depths = load_dataset(file_path).depth
+            for depth, count in enumerate(np.bincount(depths).tolist()):
+                if count:
                     max_depth = max(max_depth, depth)
-                    depth_dict[depth] += 1
+                    depth_dict[depth] += count
 
         data = {}
         for file_path, depth_dict, name in xd:
@@ -1,53 +1,145 @@
 import argparse
-import json
+import io
 import pathlib
-import sys
+import resource
 import time
-from collections import defaultdict
+from typing import Dict, Tuple, Union
 
+import joblib
 import numpy as np
-from joblib import load
-
-from models import x_keys, y_key
-
-
-def evaluate_model(model, test_path: pathlib.Path, silent=False):
-    d = defaultdict(lambda: {
-        'errors': [],
-        'lowest_makespan': int(sys.float_info.max),
-    })
-    with test_path.open() as f:
-        i = 0
-        for line in f:
-            i += 1
-            data = json.loads(line)
-            X = [data[key] for key in x_keys]
-            y = data[y_key]
-
-            prediction = model.predict([X])[0]
-            if not np.isscalar(prediction):
-                prediction = prediction[0]
-            error = abs(prediction - y)
-            key = (data['relPath'], data['problemName'])
-            d[key]['errors'].append(error)
-            d[key]['lowest_makespan'] = min(d[key]['lowest_makespan'], y)
-
-    prediction_count = 0
+
+from columnar_dataset import ColumnarDataset, iter_chunks
+from compiled_models import load_model
+
+# rows predicted at once, bounds the memory used besides the (memory-mapped) dataset
+DEFAULT_CHUNK_SIZE = 1 << 16
+# single-row predictions timed per model, and the size and count of the timed batches (a few states of a search step)
+LATENCY_ROWS = 200
+LATENCY_BATCH_SIZE = 64
+LATENCY_BATCHES = 20
+# rounds of the above, of which the quietest is reported, so a burst of other activity does not decide the p99
+LATENCY_REPEATS = 3
+
+
+def evaluate_model(model, test_path: Union[pathlib.Path, ColumnarDataset], silent=False,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """
+    Predicts the test set (a path or an already loaded dataset) in chunks and aggregates the absolute errors per
+    (relPath, problemName). A jsonl file is read chunk by chunk as well, so besides a memory-mapped dataset only a
+    chunk and the per-problem sums are in memory.
+    Returns the per-problem results, the error percentages, the number of predictions and the time spent predicting.
+    """
+    chunk = None
+    y_integral = True
+    slots: Dict[int, int] = {}  # group key -> index into the arrays below, in order of first appearance
+    error_sums = np.zeros(0)
+    counts = np.zeros(0, dtype=np.int64)
+    lowest_makespans = np.zeros(0)
+    predict_seconds = 0.0
+
+    for chunk in iter_chunks(test_path, chunk_size):
+        X = np.asarray(chunk.X)
+        y = np.asarray(chunk.y)
+        y_integral = y_integral and chunk.y_integral
+        t_start = time.perf_counter()
+        predictions = np.asarray(model.predict(X)).reshape(len(X), -1)[:, 0]
+        predict_seconds += time.perf_counter() - t_start
+        errors = np.abs(predictions - y)
+
+        # the number of problems of a jsonl file is not known up front, so both codes get 32 bits of the key
+        keys = (chunk.rel_path.astype(np.int64) << 32) + chunk.problem_name
+        unique_keys, first_rows, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        for i in np.argsort(first_rows):
+            slots.setdefault(int(unique_keys[i]), len(slots))
+        if len(slots) > len(counts):
+            grow = len(slots) - len(counts)
+            error_sums = np.concatenate([error_sums, np.zeros(grow)])
+            counts = np.concatenate([counts, np.zeros(grow, dtype=np.int64)])
+            lowest_makespans = np.concatenate([lowest_makespans, np.full(grow, np.inf)])
+        groups = np.array([slots[int(key)] for key in unique_keys], dtype=np.intp)[inverse.reshape(-1)]
+        # unbuffered, in row order, so the sums are exactly those of adding the errors one by one
+        np.add.at(error_sums, groups, errors)
+        np.minimum.at(lowest_makespans, groups, y)
+        counts += np.bincount(groups, minlength=len(counts))
+
+    d: Dict[Tuple[str, str], dict] = {}
     all_percentages = []
-    for k, v in d.items():
-        errors = v['errors']
-        error_count = len(errors)
-        error_avg = sum(errors) / error_count
-        lowest_makespan = v['lowest_makespan']
+    for key, slot in slots.items():
+        k = (chunk.rel_paths[key >> 32], chunk.problem_names[key & 0xffffffff])
+        error_avg = error_sums[slot] / counts[slot]
+        lowest_makespan = lowest_makespans[slot]
+        if y_integral:
+            # reported in the type of the data, as the (exact) minimum of integers
+            lowest_makespan = int(lowest_makespan)
         error_percentage = error_avg / lowest_makespan * 100
         all_percentages.append(error_percentage)
-        prediction_count += error_count
+        d[k] = {'count': int(counts[slot]), 'error_avg': error_avg, 'lowest_makespan': lowest_makespan}
         if not silent:
             print(f"{k}:")
             print(f"\tLowest makespan: {lowest_makespan}")
             print(f"\tAverage error: {error_avg} ({error_percentage}%)")
 
-    return d, all_percentages, prediction_count
+    return d, all_percentages, int(counts.sum()), predict_seconds
+
+
+def measure_latency(model, dataset: ColumnarDataset, rows: int = LATENCY_ROWS, batch_size: int = LATENCY_BATCH_SIZE,
+                    batches: int = LATENCY_BATCHES, repeats: int = LATENCY_REPEATS) -> dict:
+    """
+    Times predicting single rows and small batches of the dataset one call at a time, as the scheduler's search does.
+    Returns the p50 and p99 latency of both in microseconds, each the lowest of `repeats` rounds.
+    Run it while nothing else is busy on the machine, it measures the model and not CPU contention.
+    """
+    X = np.ascontiguousarray(dataset.X[:max(rows, batch_size)])
+    if len(X) == 0:
+        return {}
+    model.predict(X[:1])  # warm up
+    single = np.empty((repeats, min(rows, len(X))))
+    batch = np.empty((repeats, batches))
+    for repeat in range(repeats):
+        for i in range(single.shape[1]):
+            t_start = time.perf_counter_ns()
+            model.predict(X[i:i + 1])
+            single[repeat, i] = time.perf_counter_ns() - t_start
+        for i in range(batches):
+            t_start = time.perf_counter_ns()
+            model.predict(X[:batch_size])
+            batch[repeat, i] = time.perf_counter_ns() - t_start
+    return {
+        'singleP50Us': np.percentile(single, 50, axis=1).min() / 1e3,
+        'singleP99Us': np.percentile(single, 99, axis=1).min() / 1e3,
+        'batchSize': min(batch_size, len(X)),
+        'batchP50Us': np.percentile(batch, 50, axis=1).min() / 1e3,
+        'batchP99Us': np.percentile(batch, 99, axis=1).min() / 1e3,
+    }
+
+
+def model_size(model) -> int:
+    """Size in bytes of the model as written by joblib.dump"""
+    f = io.BytesIO()
+    joblib.dump(model, f)
+    return f.tell()
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak RSS of this process (Linux only), returns False if peak_rss stays the peak since the start"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes, since the last reset_peak_rss"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
 
 def main():
@@ -60,14 +152,21 @@ def main():
         '--input',
         required=True,
         type=pathlib.Path,
-        help='The test jsonl file',
+        help='The test jsonl file or columnar dataset',
     )
     parser.add_argument(
         '-m',
         '--model',
         required=True,
         type=pathlib.Path,
-        help='The trained model (.joblib) to load',
+        help='The trained (or compiled) model (.joblib) to load',
+    )
+    parser.add_argument(
+        '-b',
+        '--chunk-size',
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help='The amount of rows to predict at once',
     )
 
     args = parser.parse_args()
@@ -80,10 +179,14 @@ def main():
         print(f"Input file '{args.input}' does not exist")
         exit(1)
 
-    model = load(args.model)
+    reset_peak_rss()
+    model = load_model(args.model)
     t_start = time.time()
-    d, all_error_percentages, prediction_count = evaluate_model(model, args.input)
+    d, all_error_percentages, prediction_count, predict_seconds = evaluate_model(model, args.input,
+                                                                                 chunk_size=args.chunk_size)
     t_diff = time.time() - t_start
+    head = next(iter_chunks(args.input, max(LATENCY_ROWS, LATENCY_BATCH_SIZE)), None)
+    latency = measure_latency(model, head) if head is not None else {}
 
     all_error_percentages.sort()
     mean = np.mean(all_error_percentages)
@@ -96,7 +199,14 @@ def main():
     print()
     print(f"Total problems: {len(d)}")
     print(f"Average error percentage: {mean}% (std: {std}), 95%: {mean_95}% (std: {std_95})")
-    print(f"Average time per prediction: {t_diff / prediction_count}s")
+    print(f"Predictions per second: {prediction_count / predict_seconds:.0f} "
+          f"({prediction_count / t_diff:.0f} including loading and aggregation)")
+    if latency:
+        print(f"Single-row latency: p50 {latency['singleP50Us']:.1f}us, p99 {latency['singleP99Us']:.1f}us")
+        print(f"Batch latency ({latency['batchSize']} rows): p50 {latency['batchP50Us']:.1f}us, "
+              f"p99 {latency['batchP99Us']:.1f}us")
+    print(f"Model size: {args.model.stat().st_size} bytes")
+    print(f"Peak RSS: {peak_rss() / 2 ** 20:.1f} MiB")
     print(f"Total time: {t_diff}s")
     print(f"Total predictions: {prediction_count}")
 
@@ -1,56 +1,95 @@
 import argparse
-import json
+import concurrent.futures
+import hashlib
 import os
 import pathlib
 import pickle
+import tempfile
+from typing import List
 
 import matplotlib.pyplot as plt
 import numpy as np
-from joblib import load
-from models import x_keys, y_key
+from columnar_dataset import load_dataset
+from compiled_models import MAPPED_SUFFIX, load_model
 
+CACHE_DIR = "cache"
+# rows predicted at once
+CHUNK_SIZE = 1 << 16
 
-def make_graph(path: pathlib.Path, test_path: pathlib.Path):
+
+def fingerprint(path: pathlib.Path) -> str:
+    """Identifies a model file or dataset (file or columnar folder) by its path, sizes and modification times"""
+    files = sorted(p for p in path.iterdir() if p.is_file()) if path.is_dir() else [path]
+    parts = []
+    for file in files:
+        stat = file.stat()
+        parts.append(f"{file.resolve()}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def predict_model(model_path: pathlib.Path, X_path: str, cache_path: pathlib.Path) -> pathlib.Path:
+    """Predicts the (memory-mapped) test matrix with one model and saves the predictions to the cache"""
+    model = load_model(model_path)
+    X = np.load(X_path, mmap_mode='r')
+    predictions = np.empty(len(X))
+    for start in range(0, len(X), CHUNK_SIZE):
+        X_chunk = np.asarray(X[start:start + CHUNK_SIZE])
+        predictions[start:start + CHUNK_SIZE] = np.asarray(model.predict(X_chunk)).reshape(len(X_chunk), -1)[:, 0]
+    tmp_path = cache_path.with_suffix('.tmp.npy')
+    np.save(tmp_path, predictions)
+    os.replace(tmp_path, cache_path)
+    print('model done!', model_path.name)
+    return cache_path
+
+
+def model_files(path: pathlib.Path) -> List[pathlib.Path]:
+    return sorted([*path.glob('*.joblib'), *path.glob(f'*{MAPPED_SUFFIX}')])
+
+
+def make_graph(path: pathlib.Path, test_path: pathlib.Path, jobs: int):
     plt.rcParams.update({
         'font.size': 18
     })
+    dataset = load_dataset(test_path)
+    dataset_fingerprint = fingerprint(test_path)
+    files = model_files(path)
+    stems = [file.stem for file in files]
+    names = {file: file.stem if stems.count(file.stem) == 1 else file.name for file in files}
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_paths = {}
+    for file in files:
+        key = hashlib.sha1(f"{fingerprint(file)}|{dataset_fingerprint}".encode('utf-8')).hexdigest()[:16]
+        cache_paths[file] = pathlib.Path(CACHE_DIR) / f"depth-error-{names[file]}-{key}.npy"
+    missing = [file for file in files if not cache_paths[file].exists()]
+    print(f"{len(files) - len(missing)} of {len(files)} models cached, predicting {[names[f] for f in missing]}")
+
+    if missing:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the workers memory-map the test matrix instead of each getting a pickled copy
+            X_path = getattr(dataset.X, 'filename', None)
+            if X_path is None:
+                X_path = os.path.join(tmp_dir, 'X.npy')
+                np.save(X_path, dataset.X)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(predict_model, file, X_path, cache_paths[file]) for file in missing]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+
+    y = np.asarray(dataset.y)
+    depth = np.asarray(dataset.depth)
+    counts = np.bincount(depth)
+    depths = np.flatnonzero(counts)
     data_pickle = {}
-    for file in path.glob('*.joblib'):
-        name = str(file).split('.')[0].split('/')[1]
-        model = load(file)
-        results = dict()
-        with test_path.open() as f:
-            i = 0
-            for line in f:
-                if name == "SVR" and i % 100 == 0:
-                    print(i)
-                i += 1
-                data = json.loads(line)
-                X = [data[key] for key in x_keys]
-                y = data[y_key]
-
-                prediction = model.predict([X])[0]
-                if not np.isscalar(prediction):
-                    prediction = prediction[0]
-                error = abs(prediction - y) / y * 100
-                if data['vertexDepth'] not in results:
-                    results[data['vertexDepth']] = [error]
-                else:
-                    results[data['vertexDepth']].append(error)
-        x = []
-        y = []
-        for key, value in results.items():
-            x.append(key)
-            y.append(sum(value) / len(value))
-        print('model done!', name)
-        plt.plot(x, y, label= name)
-        data_pickle[name] = (x, y)
-        # ax2.plot(x, y, label= name)
+    for file in files:
+        predictions = np.load(cache_paths[file])
+        errors = np.abs(predictions - y) / y * 100
+        mean_errors = np.bincount(depth, weights=errors, minlength=len(counts))[depths] / counts[depths]
+        data_pickle[names[file]] = (depths.tolist(), mean_errors.tolist())
 
     # ax.set_ylim(2000, 200000)  # outliers only
     pickle.dump(data_pickle, open("depthErrorData.pickle", "wb"))
-    d = pickle.load(open("depthErrorData.pickle", "rb"))
-    for n, r in d.items():
+    for n, r in data_pickle.items():
         plt.plot(r[0], r[1], label=n)
 
     plt.ylim(0, 110)  # most of the data
@@ -73,7 +112,7 @@ if __name__ == "__main__":
         '--input',
         required=True,
         type=pathlib.Path,
-        help='The file containing all the the testing data',
+        help='The file (or columnar dataset) containing all the the testing data',
     )
 
     parser.add_argument(
@@ -83,9 +122,16 @@ if __name__ == "__main__":
         type=pathlib.Path,
         help='The folder containing all the models',
     )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='The amount of models to evaluate in parallel',
+    )
     args = parser.parse_args()
 
     if not os.path.exists(args.input):
         print(f"Input file '{args.input}' does not exist")
         exit(1)
-    make_graph(args.model, args.input)
+    make_graph(args.model, args.input, args.jobs)
@@ -1,20 +1,30 @@
 import argparse
 import concurrent.futures
+import hashlib
 import itertools
 import json
+import math
+import os
 import pathlib
+import shutil
+import tempfile
+import time
+import warnings
+from typing import Optional
 
 import joblib
 import numpy as np
 import tqdm
 from sklearn.cross_decomposition import PLSRegression
+from sklearn.exceptions import ConvergenceWarning
 from sklearn.neighbors import KNeighborsRegressor
 from sklearn.neural_network import MLPRegressor
 from sklearn.tree import DecisionTreeRegressor
 
-from evaluate import evaluate_model
-from train import get_dataset
+from columnar_dataset import ColumnarDataset, convert, dataset_path, is_columnar, load_columnar
+from evaluate import evaluate_model, measure_latency, model_size, peak_rss, reset_peak_rss
 from utils import assert_empty
+from work_queue import DEFAULT_LEASE_SECONDS, WorkQueue
 
 all_models = {
     'KNNR': {
@@ -53,39 +63,432 @@ all_models = {
 }
 
 
-def hypertune_model(model_key, model_kwargs, train_dataset, test_path):
+# Successive halving grows these parameters (from a fraction up to the given full value) instead of the amount
+# of training rows
+budget_params = {
+    'MLPR': ('max_iter', MLPRegressor().max_iter),
+}
+# the subsamples of successive halving are prefixes of one fixed permutation, so they are nested
+SUBSAMPLE_SEED = 1
+# Every evaluated configuration, one json line each, appended in the output folder; a rerun skips what is in it
+JOURNAL_FILE = 'journal.jsonl'
+# The configurations no other configuration beats in both error and single-row p99 latency, written after tuning
+PARETO_FILE = 'pareto.json'
+JOURNAL_FIELDS = ('model', 'params', 'rows', 'budget', 'avgPercentage')
+# Configurations fitted per worker before the parent measures their latency, which bounds the models held at once
+FIT_BATCH_PER_WORKER = 2
+
+# datasets a worker process has mapped, by path, so every task after the first one gets them for free
+worker_datasets = {}
+worker_permutations = {}
+
+
+def worker_dataset(path: pathlib.Path) -> ColumnarDataset:
+    if path not in worker_datasets:
+        worker_datasets[path] = load_columnar(path)
+    return worker_datasets[path]
+
+
+def share_dataset(path: pathlib.Path, tmp_dir: str, name: str) -> pathlib.Path:
+    """Returns a columnar (memory-mappable) version of the dataset, converting a jsonl file once"""
+    if is_columnar(path):
+        return path
+    output = pathlib.Path(tmp_dir) / name
+    os.makedirs(output)
+    convert(path, output)
+    return output
+
+
+def subsample(rows: int, total: int) -> np.ndarray:
+    """Indices of `rows` random training rows (the same in every worker), in storage order"""
+    if total not in worker_permutations:
+        worker_permutations[total] = np.random.default_rng(SUBSAMPLE_SEED).permutation(total)
+    return np.sort(worker_permutations[total][:rows])
+
+
+def configurations(model_key):
+    """Every combination of the model's parameter grid, as keyword arguments"""
+    params = all_models[model_key]['params']
+    keys = list(params.keys())
+    return [dict(zip(keys, args)) for args in itertools.product(*[params[key] for key in keys])]
+
+
+def hypertune_model(model_key, model_kwargs, train_path: pathlib.Path, test_path: pathlib.Path,
+                    rows: Optional[int] = None, budget: Optional[int] = None):
+    """
+    Fits and evaluates one configuration, on a subsample of `rows` rows or with a reduced `budget` if given.
+    Besides the mean error it returns the cost of the configuration: fit and predict time, the model size and the
+    peak RSS of fitting and evaluating it. The predict latency is measured by the parent (see fit_in_batches), as the
+    other workers would make it mostly measure CPU contention.
+    """
     Model = all_models[model_key]['model']
-    model = Model(**model_kwargs)
-    model.fit(*train_dataset)
-    _, all_percentages, _ = evaluate_model(model, test_path, silent=True)
+    fit_kwargs = model_kwargs if budget is None else {**model_kwargs, budget_params[model_key][0]: budget}
+    model = Model(**fit_kwargs)
+    train_dataset = worker_dataset(train_path)
+    X, y = train_dataset.X, train_dataset.y
+    if rows is not None and rows < len(train_dataset):
+        indices = subsample(rows, len(train_dataset))
+        X, y = X[indices], y[indices]
+    reset_peak_rss()
+    t_start = time.perf_counter()
+    with warnings.catch_warnings():
+        if budget is not None:
+            # not converging is the point of a reduced budget
+            warnings.simplefilter('ignore', ConvergenceWarning)
+        model.fit(X, y)
+    fit_seconds = time.perf_counter() - t_start
+    test_dataset = worker_dataset(test_path)
+    _, all_percentages, _, predict_seconds = evaluate_model(model, test_dataset, silent=True)
     mean = np.mean(all_percentages)
-    return model, model_key, mean, model_kwargs
-
-
-def hypertune(models, train_path: pathlib.Path, test_path: pathlib.Path, output: pathlib.Path):
-    train_dataset = get_dataset(train_path)
-
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = []
-        for model_key in models:
-            model = all_models[model_key]
-            keys = list(model['params'].keys())
-            for args in itertools.product(*[model['params'][key] for key in keys]):
-                future = executor.submit(hypertune_model, model_key, dict(zip(keys, args)), train_dataset, test_path)
-                futures.append(future)
-
-        best_models = {}
-        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc='Hyperparameter Tuning'):
-            model, model_key, avg_percentage, model_kwargs = future.result()
-            if model_key not in best_models or avg_percentage < best_models[model_key]['avg_percentage']:
-                data = {
-                    'avg_percentage': avg_percentage,
-                    'model_kwargs': model_kwargs,
-                }
-                best_models[model_key] = data
-                with open(output / f'{model_key}.json', 'w') as f:
-                    json.dump(data, f, indent=4)
-                joblib.dump(model, output / f'{model_key}.joblib')
+    cost = {
+        'fitSeconds': fit_seconds,
+        'predictSeconds': predict_seconds,
+        'sizeBytes': model_size(model),
+        'peakRssBytes': peak_rss(),
+    }
+    return model, model_key, mean, model_kwargs, cost
+
+
+def add_latency(journal: dict, journal_file, model, model_key, model_kwargs, rows, budget, avg_percentage,
+                cost: dict, test_path: pathlib.Path) -> dict:
+    """
+    Measures the predict latency of the model in this process, while no configuration is being fitted, and journals
+    the configuration with it. Returns the cost including the latency.
+    """
+    cost = {**cost, **measure_latency(model, worker_dataset(test_path))}
+    write_journal(journal_file, journal, model_key, model_kwargs, rows, budget, avg_percentage, cost)
+    return cost
+
+
+def within_cap(cost: dict, max_latency_us: Optional[float]) -> bool:
+    """Whether the single-row p99 latency is within the cap (unknown latency, from an older journal, is not)"""
+    return max_latency_us is None or cost.get('singleP99Us', math.inf) <= max_latency_us
+
+
+def journal_key(model_key, model_kwargs, rows: Optional[int] = None, budget: Optional[int] = None):
+    """Identifies a configuration and the resources it was fitted with (None meaning all of them)"""
+    return model_key, json.dumps(model_kwargs, sort_keys=True), rows, budget
+
+
+def load_journal(path: pathlib.Path) -> dict:
+    """The journal entries by journal_key, a later entry of the same configuration replaces an earlier one"""
+    journal = {}
+    if not path.exists():
+        return journal
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a job that was killed while writing it
+                continue
+            journal[journal_key(entry['model'], entry['params'], entry['rows'], entry['budget'])] = entry
+    return journal
+
+
+def write_journal(f, journal: dict, model_key, model_kwargs, rows, budget, avg_percentage, cost: dict):
+    entry = {
+        'model': model_key,
+        'params': model_kwargs,
+        'rows': rows,
+        'budget': budget,
+        'avgPercentage': avg_percentage,
+        **cost,
+    }
+    journal[journal_key(model_key, model_kwargs, rows, budget)] = entry
+    f.write(json.dumps(entry) + '\n')
+    # written as soon as the configuration is done, so a job killed at its walltime loses at most the running ones
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def entry_cost(entry: dict) -> dict:
+    return {key: value for key, value in entry.items() if key not in JOURNAL_FIELDS}
+
+
+def save_best(best_models: dict, output: pathlib.Path, model, model_key, avg_percentage, model_kwargs, cost: dict,
+              max_latency_us: Optional[float] = None):
+    """
+    Keeps the configuration if it is the best so far and within the latency cap.
+    Without a model (a journaled result) only the json is written.
+    """
+    if not within_cap(cost, max_latency_us):
+        return
+    if model_key not in best_models or avg_percentage < best_models[model_key]['avg_percentage']:
+        data = {
+            'avg_percentage': avg_percentage,
+            'model_kwargs': model_kwargs,
+            'cost': cost,
+        }
+        best_models[model_key] = data
+        # the model before the json, so a json always describes the model next to it
+        if model is not None:
+            joblib.dump(model, output / f'{model_key}.joblib')
+        with open(output / f'{model_key}.json', 'w') as f:
+            json.dump(data, f, indent=4)
+
+
+def restore_best(models, journal: dict, output: pathlib.Path, train_path: pathlib.Path, test_path: pathlib.Path,
+                 max_latency_us: Optional[float] = None) -> dict:
+    """
+    The best models from the configurations fitted on all rows in the journal. A configuration is journaled before
+    its model file is written, so it is only fitted again if the run was killed in between.
+    """
+    saved_kwargs = {}
+    for model_key in models:
+        if (output / f'{model_key}.json').exists() and (output / f'{model_key}.joblib').exists():
+            with open(output / f'{model_key}.json', 'r') as f:
+                saved_kwargs[model_key] = json.load(f)['model_kwargs']
+    best = {}
+    for entry in journal.values():
+        model_key = entry['model']
+        if model_key in models and entry['rows'] is None and entry['budget'] is None \
+                and within_cap(entry_cost(entry), max_latency_us) \
+                and (model_key not in best or entry['avgPercentage'] < best[model_key]['avgPercentage']):
+            best[model_key] = entry
+    best_models = {}
+    for model_key, entry in best.items():
+        model = None
+        if saved_kwargs.get(model_key) != entry['params']:
+            print(f"{model_key}.joblib is not the best configuration in the journal, fitting that one again")
+            model = hypertune_model(model_key, entry['params'], train_path, test_path)[0]
+        # writes the refitted model before the json, so an interrupted refit is detected again on the next run
+        save_best(best_models, output, model, model_key, entry['avgPercentage'], entry['params'], entry_cost(entry))
+    return best_models
+
+
+def fit_in_batches(executor: concurrent.futures.Executor, tasks: list, train_path: pathlib.Path,
+                   test_path: pathlib.Path, batch_size: int, desc: str):
+    """
+    Fits the (model_key, model_kwargs, rows, budget) tasks, batch_size at a time, and yields their results in task
+    order with the predict latency in their cost. The latency of a batch is measured in this process, one model after
+    the other, once the batch is done and the workers are idle, so at most one batch of models is held at once.
+    """
+    with tqdm.tqdm(total=len(tasks), desc=desc) as progress:
+        for start in range(0, len(tasks), batch_size):
+            futures = [executor.submit(hypertune_model, model_key, model_kwargs, train_path, test_path, rows, budget)
+                       for model_key, model_kwargs, rows, budget in tasks[start:start + batch_size]]
+            for _ in concurrent.futures.as_completed(futures):
+                progress.update()
+            for future in futures:
+                model, model_key, avg_percentage, model_kwargs, cost = future.result()
+                cost = {**cost, **measure_latency(model, worker_dataset(test_path))}
+                yield model, model_key, avg_percentage, model_kwargs, cost
+
+
+def pareto_front(entries) -> list:
+    """The entries no other entry beats in both error and single-row p99 latency, fastest first"""
+    candidates = [entry for entry in entries if 'singleP99Us' in entry and not np.isnan(entry['avgPercentage'])]
+    candidates.sort(key=lambda entry: (entry['singleP99Us'], entry['avgPercentage']))
+    front = []
+    for entry in candidates:
+        if not front or entry['avgPercentage'] < front[-1]['avgPercentage']:
+            front.append(entry)
+    return front
+
+
+def save_pareto_front(models, journal: dict, output: pathlib.Path):
+    front = pareto_front(entry for entry in journal.values()
+                         if entry['model'] in models and entry['rows'] is None and entry['budget'] is None)
+    with open(output / PARETO_FILE, 'w') as f:
+        json.dump(front, f, indent=4)
+    print("Pareto front of error against single-row p99 latency:")
+    for entry in front:
+        print(f"\t{entry['avgPercentage']:8.3f}% {entry['singleP99Us']:10.1f}us {entry['sizeBytes']:>12} bytes  "
+              f"{entry['model']} {json.dumps(entry['params'])}")
+
+
+def hypertune(models, train_path: pathlib.Path, test_path: pathlib.Path, output: pathlib.Path, search: str = 'grid',
+              min_rows: int = 10_000, factor: int = 2, max_latency_us: Optional[float] = None):
+    journal_path = output / JOURNAL_FILE
+    journal = load_journal(journal_path)
+    with tempfile.TemporaryDirectory() as tmp_dir, open(journal_path, 'a') as journal_file:
+        if journal_file.tell() and not journal_path.read_text().endswith('\n'):
+            # the cut off line of a killed job was skipped by load_journal, do not append to it
+            journal_file.write('\n')
+        # the workers map the same files, a task only carries the paths
+        train_path = share_dataset(train_path, tmp_dir, 'train')
+        test_path = share_dataset(test_path, tmp_dir, 'test')
+        # the best models of a killed run, the new configurations have to beat them
+        best_models = restore_best(models, journal, output, train_path, test_path, max_latency_us)
+        workers = os.cpu_count() or 1
+        batch_size = FIT_BATCH_PER_WORKER * workers
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            if search == 'halving':
+                for model_key in models:
+                    successive_halving(executor, model_key, train_path, test_path, output, min_rows, factor,
+                                       journal, journal_file, best_models, batch_size, max_latency_us)
+            else:
+                grid_search(executor, models, train_path, test_path, output, journal, journal_file, best_models,
+                            batch_size, max_latency_us)
+    save_pareto_front(models, journal, output)
+    for model_key in models:
+        if model_key not in best_models:
+            print(f"No {model_key} configuration is within the latency cap of {max_latency_us}us")
+
+
+def successive_halving(executor: concurrent.futures.Executor, model_key, train_path: pathlib.Path,
+                       test_path: pathlib.Path, output: pathlib.Path, min_rows: int, factor: int, journal: dict,
+                       journal_file, best_models: dict, batch_size: int, max_latency_us: Optional[float] = None):
+    """
+    Evaluates all configurations of the grid with a fraction of the training rows (or of the budget parameter),
+    keeps the best 1/factor of them and repeats with factor times the rows, until the last round uses all of them.
+    There are only as many rounds as the resource can be divided by factor (down to min_rows rows or one iteration),
+    so every round fits on more of it; the last round then has more than factor candidates left.
+    Configurations in the journal are not fitted again, their journaled error is used. The best model fitted on all
+    rows within the latency cap is saved to `best_models`.
+    The latency of the fits is measured between batches while the workers are idle, and configurations over the
+    latency cap are ranked after all others (a subsample does not make a model slower).
+    """
+    candidates = configurations(model_key)
+    total_rows = len(load_columnar(train_path))
+    if model_key in budget_params:
+        total, least = budget_params[model_key][1], 1
+    else:
+        total, least = total_rows, min(min_rows, total_rows)
+    # enough rounds to get down to at most `factor` candidates in the last one, but no two rounds on the same amount
+    rounds = 1
+    remaining = len(candidates)
+    while remaining > factor and total // factor ** rounds >= least:
+        remaining = math.ceil(remaining / factor)
+        rounds += 1
+
+    for i in range(rounds):
+        shrink = factor ** (rounds - 1 - i)
+        rows = budget = None
+        if model_key in budget_params:
+            budget = total // shrink
+            resource = f"{budget_params[model_key][0]}={budget}"
+            # the full budget is journaled like a grid search configuration
+            budget = budget if budget < budget_params[model_key][1] else None
+        else:
+            rows = total // shrink
+            resource = f"{rows} rows"
+            rows = rows if rows < total_rows else None
+        results = [None] * len(candidates)
+        pending = []
+        for j, model_kwargs in enumerate(candidates):
+            entry = journal.get(journal_key(model_key, model_kwargs, rows, budget))
+            if entry is not None:
+                results[j] = (None, model_key, entry['avgPercentage'], model_kwargs, entry_cost(entry))
+            else:
+                pending.append(j)
+        tasks = [(model_key, candidates[j], rows, budget) for j in pending]
+        desc = f'{model_key} round {i + 1}/{rounds} ({resource})'
+        fits = fit_in_batches(executor, tasks, train_path, test_path, batch_size, desc)
+        for j, (model, _, avg_percentage, model_kwargs, cost) in zip(pending, fits):
+            write_journal(journal_file, journal, model_key, model_kwargs, rows, budget, avg_percentage, cost)
+            if rows is None and budget is None:
+                save_best(best_models, output, model, model_key, avg_percentage, model_kwargs, cost, max_latency_us)
+            results[j] = (None, model_key, avg_percentage, model_kwargs, cost)
+        # in candidate order, so ties go to the same configuration every run
+        results.sort(key=lambda result: (not within_cap(result[4], max_latency_us), np.isnan(result[2]), result[2]))
+        if i == rounds - 1:
+            return
+        candidates = [result[3] for result in results[:math.ceil(len(results) / factor)]]
+
+
+def grid_search(executor: concurrent.futures.Executor, models, train_path: pathlib.Path, test_path: pathlib.Path,
+                output: pathlib.Path, journal: dict, journal_file, best_models: dict, batch_size: int,
+                max_latency_us: Optional[float] = None):
+    """
+    Fits every configuration that is not in the journal yet and journals it with its latency. A model is only kept if
+    it is the best one within the latency cap so far.
+    """
+    tasks = []
+    skipped = 0
+    for model_key in models:
+        for model_kwargs in configurations(model_key):
+            if journal_key(model_key, model_kwargs) in journal:
+                skipped += 1
+                continue
+            tasks.append((model_key, model_kwargs, None, None))
+    if skipped:
+        print(f"Skipping {skipped} configurations that are in the journal")
+
+    fits = fit_in_batches(executor, tasks, train_path, test_path, batch_size, 'Hyperparameter Tuning')
+    for model, model_key, avg_percentage, model_kwargs, cost in fits:
+        # journaled first, so restore_best fits the model again if the run is killed before it is written
+        write_journal(journal_file, journal, model_key, model_kwargs, None, None, avg_percentage, cost)
+        save_best(best_models, output, model, model_key, avg_percentage, model_kwargs, cost, max_latency_us)
+
+
+def task_id(model_key, model_kwargs) -> str:
+    return f"{model_key}-{hashlib.sha1(json.dumps(model_kwargs, sort_keys=True).encode()).hexdigest()[:16]}"
+
+
+def queue_worker(queue: WorkQueue, models, train_path: pathlib.Path, test_path: pathlib.Path, output: pathlib.Path,
+                 max_latency_us: Optional[float] = None):
+    """
+    Runs on every rank: adds the grid to the queue, fits the configurations it claims until none are left and, if it
+    is the first rank to see them all done, reduces the results into the output folder.
+    """
+    for model_key in models:
+        for model_kwargs in configurations(model_key):
+            queue.add(task_id(model_key, model_kwargs), {'model': model_key, 'params': model_kwargs})
+
+    fitted = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shared_train = share_dataset(train_path, tmp_dir, 'train')
+        shared_test = share_dataset(test_path, tmp_dir, 'test')
+        while (claim := queue.wait()) is not None:
+            with queue.hold(claim):
+                model, model_key, avg_percentage, model_kwargs, cost = hypertune_model(
+                    claim.task['model'], claim.task['params'], shared_train, shared_test)
+                model_path = queue.result_path(claim.task_id, '.joblib')
+                joblib.dump(model, model_path.with_name(f'.{model_path.name}.{queue.owner}'))
+                os.replace(model_path.with_name(f'.{model_path.name}.{queue.owner}'), model_path)
+                queue.complete(claim, {
+                    'model': model_key,
+                    'params': model_kwargs,
+                    'rows': None,
+                    'budget': None,
+                    'avgPercentage': avg_percentage,
+                    **cost,
+                })
+            fitted += 1
+            print(f"Fitted {claim.task_id} ({avg_percentage:.3f}%)")
+    print(f"Fitted {fitted} configurations, the queue is done")
+
+    # named after the results, so tasks added and finished later get reduced again
+    done = hashlib.sha1(' '.join(sorted(queue.done_ids())).encode()).hexdigest()[:16]
+    if queue.try_lock(f'reduce-{done}'):
+        reduce_queue(queue, models, output, test_path, max_latency_us)
+
+
+def reduce_queue(queue: WorkQueue, models, output: pathlib.Path, test_path: pathlib.Path,
+                 max_latency_us: Optional[float] = None):
+    """
+    Merges the results of all ranks into the best models, the journal and the Pareto front of the output folder.
+    The latency of every model is measured here, one after the other, as the ranks share their nodes.
+    """
+    os.makedirs(output, exist_ok=True)
+    journal_path = output / JOURNAL_FILE
+    journal = load_journal(journal_path)
+    best = {}
+    with tempfile.TemporaryDirectory() as tmp_dir, open(journal_path, 'a') as journal_file:
+        test_path = share_dataset(test_path, tmp_dir, 'test')
+        for result_id, entry in tqdm.tqdm(sorted(queue.results().items()), desc='Measuring latency'):
+            model_key = entry['model']
+            if model_key not in models:
+                continue
+            journaled = journal.get(journal_key(model_key, entry['params']))
+            if journaled is not None and 'singleP99Us' in journaled:
+                cost = entry_cost(journaled)
+            else:
+                cost = add_latency(journal, journal_file, joblib.load(queue.result_path(result_id, '.joblib')),
+                                   model_key, entry['params'], None, None, entry['avgPercentage'], entry_cost(entry),
+                                   test_path)
+            if within_cap(cost, max_latency_us) and (
+                    model_key not in best or entry['avgPercentage'] < best[model_key][1]['avgPercentage']):
+                best[model_key] = (result_id, entry, cost)
+
+    best_models = {}
+    for model_key, (result_id, entry, cost) in best.items():
+        shutil.copyfile(queue.result_path(result_id, '.joblib'), output / f'{model_key}.joblib')
+        save_best(best_models, output, None, model_key, entry['avgPercentage'], entry['params'], cost)
+    print(f"Reduced {len(journal)} configurations into {output}")
+    save_pareto_front(models, journal, output)
 
 
 if __name__ == '__main__':
@@ -98,7 +501,7 @@ if __name__ == '__main__':
         '--input',
         required=True,
         type=pathlib.Path,
-        help='The folder containing the train and test jsonl files',
+        help='The folder containing the train and test jsonl files (or their columnar datasets)',
     )
     parser.add_argument(
         '-o',
@@ -119,12 +522,63 @@ if __name__ == '__main__':
         '-c',
         '--clean',
         action=argparse.BooleanOptionalAction,
-        help='Clean the output model before writing to it',
+        help='Clean the output model (and the journal) before writing to it',
+    )
+    parser.add_argument(
+        '-r',
+        '--resume',
+        action=argparse.BooleanOptionalAction,
+        help='Continue from the journal in the output folder, skipping the configurations that were evaluated',
+    )
+    parser.add_argument(
+        '-s',
+        '--search',
+        default='grid',
+        choices=['grid', 'halving'],
+        help='Fit every configuration on all rows (grid) or drop the worse ones on growing subsamples (halving)',
+    )
+    parser.add_argument(
+        '--min-rows',
+        type=int,
+        default=10_000,
+        help='(halving) The least amount of training rows a configuration is fitted on',
+    )
+    parser.add_argument(
+        '--factor',
+        type=int,
+        default=2,
+        help='(halving) Keep the best 1/factor of the configurations each round, with factor times the rows',
+    )
+    parser.add_argument(
+        '-l',
+        '--max-latency-us',
+        type=float,
+        help='Only select configurations whose single-row p99 predict latency (in microseconds) is at most this',
+    )
+    parser.add_argument(
+        '-q',
+        '--queue',
+        type=pathlib.Path,
+        help='(grid) Work through a queue in this shared folder together with the other ranks started with it',
+    )
+    parser.add_argument(
+        '--lease-seconds',
+        type=float,
+        default=DEFAULT_LEASE_SECONDS,
+        help='(queue) After how long without a sign of life another rank takes over a configuration',
+    )
+    parser.add_argument(
+        '--reduce',
+        action=argparse.BooleanOptionalAction,
+        help='(queue) Only merge the results in the queue into the output folder',
     )
     args = parser.parse_args()
+    if args.factor < 2:
+        print("The halving factor must be at least 2")
+        exit(1)
 
-    input_train: pathlib.Path = args.input / 'train.jsonl'
-    input_test: pathlib.Path = args.input / 'test.jsonl'
+    input_train: pathlib.Path = dataset_path(args.input, 'train')
+    input_test: pathlib.Path = dataset_path(args.input, 'test')
     if not input_train.exists():
         print(f"Input train file '{input_train}' does not exist")
         exit(1)
@@ -133,9 +587,26 @@ if __name__ == '__main__':
         exit(1)
 
     models = list(all_models.keys()) if (args.model == ['ALL'] or args.model == 'ALL') else args.model
-    for model in models:
-        assert_empty(args.output / f'{model}.joblib', args.clean, 'file')
-        assert_empty(args.output / f'{model}.json', args.clean, 'file')
+    if args.queue is not None:
+        if args.search != 'grid':
+            print("A queue only supports grid search")
+            exit(1)
+        # the reducing rank overwrites the outputs, and it is not known in advance which one that is
+        queue = WorkQueue(args.queue, args.lease_seconds)
+        if args.reduce:
+            reduce_queue(queue, models, args.output, input_test, args.max_latency_us)
+        else:
+            queue_worker(queue, models, input_train, input_test, args.output, args.max_latency_us)
+        exit(0)
+    if args.resume:
+        os.makedirs(args.output, exist_ok=True)
+    else:
+        for model in models:
+            assert_empty(args.output / f'{model}.joblib', args.clean, 'file')
+            assert_empty(args.output / f'{model}.json', args.clean, 'file')
+        assert_empty(args.output / JOURNAL_FILE, args.clean, 'file')
+        assert_empty(args.output / PARETO_FILE, args.clean, 'file')
 
     print(f"Hyperparameter tuning models: {models}")
-    hypertune(models, input_train, input_test, args.output)
+    hypertune(models, input_train, input_test, args.output, args.search, args.min_rows, args.factor,
+              args.max_latency_us)
@@ -1,14 +1,25 @@
 import argparse
+import concurrent.futures
+import functools
+import heapq
 import json
 import os
 import pathlib
 import random
+import tempfile
 from math import ceil
+from typing import Dict, List, Optional
 
+import numpy as np
+
+from models import x_keys
 from utils import assert_empty
 
+# states converted to a record array at once
+COMPACT_CHUNK = 1 << 16
+
 
-def weighted_sample(state_data_depths, total_samples):
+def weighted_sample(state_data_depths, total_samples, rng: random.Random):
     sampled_data = []
     if len(state_data_depths) == 0:
         return sampled_data
@@ -18,7 +29,7 @@ def weighted_sample(state_data_depths, total_samples):
     for depth, state_data_list in state_data_depths.items():
         weight = (max_depth - depth) / max_depth
         depth_samples = min(ceil(samples_left * weight), len(state_data_list))
-        sampled_data.extend(random.sample(state_data_list, depth_samples))
+        sampled_data.extend(rng.sample(state_data_list, depth_samples))
         samples_left -= depth_samples
 
     # TODO: idk hack to make sure we have enough samples, for small instances is bad
@@ -29,7 +40,8 @@ def weighted_sample(state_data_depths, total_samples):
     return sampled_data
 
 
-def process(full_path: pathlib.Path, input: pathlib.Path, output: pathlib.Path, samples_per_instance: int):
+def process(full_path: pathlib.Path, input: pathlib.Path, samples_per_instance: int, seed: int) -> List[str]:
+    """Samples the states of one output file, returns them as JSON lines"""
     rel_path = full_path.relative_to(input)
     print(f"Processing {rel_path}...")
 
@@ -50,17 +62,203 @@ def process(full_path: pathlib.Path, input: pathlib.Path, output: pathlib.Path,
             state_data_depths[depth] = []
         state_data_depths[depth].append(state_data)
 
-    samples = weighted_sample(state_data_depths, samples_per_instance)
-    with open(output, 'a') as f:
-        for sample in samples:
-            json.dump(sample, f)
-            f.write('\n')
+    # seeded per file, so the samples do not depend on which worker processes the file or in which order
+    rng = random.Random(f"{seed}:{rel_path}")
+    samples = weighted_sample(state_data_depths, samples_per_instance, rng)
+    return [json.dumps(sample) + '\n' for sample in samples]
+
+
+def compact_dtype(state_data: dict) -> np.dtype:
+    """
+    What the compact mode keeps of a state; problem is an index into the problem names seen in the file. The makespan
+    and features keep the JSON type (int or float) they have in the given state, so they are written back like process
+    writes them.
+    """
+    def value_type(key: str):
+        return np.int64 if isinstance(state_data[key], int) else np.float64
+
+    return np.dtype([('stateId', np.int64), ('makespan', value_type('makespan')), ('problem', np.int32)] +
+                    [(key, value_type(key)) for key in x_keys])
+
+
+def deduplicate(records: np.ndarray) -> np.ndarray:
+    """
+    Sorts the records by depth and stateId and keeps the one with the lowest makespan (the first one on ties) of every
+    state
+    """
+    records = records[np.lexsort((records['makespan'], records['stateId'], records['vertexDepth']))]
+    keep = np.ones(len(records), dtype=bool)
+    keep[1:] = ((records['stateId'][1:] != records['stateId'][:-1]) |
+                (records['vertexDepth'][1:] != records['vertexDepth'][:-1]))
+    return records[keep]
+
+
+def depth_ranges(counts) -> Dict[int, range]:
+    """The positions of every depth in records sorted by depth, from the (depth, count) pairs in ascending depth"""
+    ranges = {}
+    start = 0
+    for depth, count in counts:
+        ranges[depth] = range(start, start + count)
+        start += count
+    return ranges
+
 
+class CompactStates:
+    """
+    Deduplicates states by stateId, holding at most about `max_states` records of `dtype` in memory.
+    When the held records are full and still more than half of them are distinct, they are spilled to `spill_dir` as
+    a run sorted by depth and stateId; finish() merges the runs. Either way the result is the same array, sorted by
+    depth and stateId, and `depths` holds the positions of every depth in it.
+    A state is expected to have the same depth wherever it appears.
+    """
 
+    def __init__(self, max_states: int, spill_dir: str, dtype: np.dtype):
+        self.max_states = max_states
+        self.spill_dir = spill_dir
+        self.dtype = dtype
+        self.depths: Dict[int, range] = {}
+        self.pending = []
+        self.chunks: List[np.ndarray] = []
+        self.held = 0
+        self.runs: List[str] = []
+        self.chunk_size = max(1, min(COMPACT_CHUNK, max_states // 2))
+
+    def add(self, state: tuple) -> None:
+        self.pending.append(state)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            self.chunks.append(np.array(self.pending, dtype=self.dtype))
+            self.held += len(self.pending)
+            self.pending = []
+        if self.held <= self.max_states:
+            return
+        records = deduplicate(np.concatenate(self.chunks))
+        # keeping more than half would deduplicate the same records again after only a few more states
+        if len(records) > self.max_states // 2:
+            path = os.path.join(self.spill_dir, f'run{len(self.runs)}.npy')
+            np.save(path, records)
+            self.runs.append(path)
+            records = records[:0]
+        self.chunks = [records]
+        self.held = len(records)
+
+    def finish(self) -> np.ndarray:
+        self.flush()
+        records = deduplicate(np.concatenate(self.chunks)) if self.chunks else np.empty(0, dtype=self.dtype)
+        if not self.runs:
+            depths, counts = np.unique(records['vertexDepth'], return_counts=True)
+            self.depths = depth_ranges(zip(depths.tolist(), counts.tolist()))
+            return records
+        if len(records):
+            path = os.path.join(self.spill_dir, f'run{len(self.runs)}.npy')
+            np.save(path, records)
+            self.runs.append(path)
+        return self.merge()
+
+    def merge(self) -> np.ndarray:
+        """
+        Merges the sorted runs into one deduplicated file, returned as a read-only memory map, and counts the states of
+        every depth on the way
+        """
+        runs = [np.load(path, mmap_mode='r') for path in self.runs]
+
+        def keys(index: int, run: np.ndarray):
+            # ties on depth, stateId and makespan go to the earliest run, like they go to the earliest state in memory
+            for start in range(0, len(run), COMPACT_CHUNK):
+                block = run[start:start + COMPACT_CHUNK]
+                columns = (block['vertexDepth'].tolist(), block['stateId'].tolist(), block['makespan'].tolist())
+                for offset, (depth, state_id, makespan) in enumerate(zip(*columns)):
+                    yield depth, state_id, makespan, index, start + offset
+
+        path = os.path.join(self.spill_dir, 'merged.bin')
+        count = 0
+        last_state = None
+        counts = {}
+        selected = []
+        with open(path, 'wb') as f:
+            for depth, state_id, _, index, position in heapq.merge(*(keys(i, run) for i, run in enumerate(runs))):
+                if (depth, state_id) == last_state:
+                    continue
+                last_state = (depth, state_id)
+                counts[depth] = counts.get(depth, 0) + 1
+                selected.append(runs[index][position])
+                if len(selected) >= COMPACT_CHUNK:
+                    f.write(np.array(selected, dtype=self.dtype).tobytes())
+                    count += len(selected)
+                    selected = []
+            f.write(np.array(selected, dtype=self.dtype).tobytes())
+            count += len(selected)
+        # the depths come out of the merge in ascending order
+        self.depths = depth_ranges(counts.items())
+        if count == 0:
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(path, dtype=self.dtype, mode='r', shape=(count,))
+
+
+def process_compact(full_path: pathlib.Path, input: pathlib.Path, samples_per_instance: int, seed: int,
+                    max_states: int, spill_dir: Optional[pathlib.Path]) -> List[str]:
+    """
+    Like process, but only keeps the stateId, depth, features and lowest makespan of every state (and writes only
+    those, plus relPath and problemName). The states of a depth are sampled in stateId order, so the samples are the
+    same whether or not the states were spilled to disk.
+    """
+    rel_path = full_path.relative_to(input)
+    print(f"Processing {rel_path} (compact)...")
 
-def postprocess(input: pathlib.Path, output: pathlib.Path, samples_per_instance: int):
-    for file in input.rglob('*.jsonl'):
-        process(file, input, output, samples_per_instance)
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+        states = None
+        problems = {}
+        with open(full_path, 'r') as f:
+            for line in f:
+                for state_data in json.loads(line):
+                    values = [state_data['makespan']] + [state_data[key] for key in x_keys]
+                    if states is None:
+                        states = CompactStates(max_states, tmp_dir, compact_dtype(state_data))
+                        types = [type(value) for value in values]
+                    elif [type(value) for value in values] != types:
+                        raise ValueError(f"{rel_path}: the makespan or features of state {state_data['stateId']} "
+                                         f"have other types than in the first state")
+                    problem = problems.setdefault(state_data.get('problemName'), len(problems))
+                    states.add((state_data['stateId'], values[0], problem, *values[1:]))
+        if states is None:
+            return []
+        records = states.finish()
+        if states.runs:
+            print(f"Spilled {rel_path} to disk in {len(states.runs)} runs")
+
+        rng = random.Random(f"{seed}:{rel_path}")
+        positions = np.asarray(weighted_sample(states.depths, samples_per_instance, rng), dtype=np.intp)
+        problem_names = list(problems.keys())
+        lines = []
+        for record in records[positions].tolist():
+            state_id, makespan, problem = record[:3]
+            sample = {'stateId': state_id}
+            sample.update(zip(x_keys, record[3:]))
+            sample['makespan'] = makespan
+            sample['relPath'] = str(rel_path.parent)
+            problem_name = problem_names[problem]
+            if problem_name is not None:
+                sample['problemName'] = problem_name
+            lines.append(json.dumps(sample) + '\n')
+        del records
+    return lines
+
+
+def postprocess(input: pathlib.Path, output: pathlib.Path, samples_per_instance: int, seed: int, jobs: int,
+                compact: bool = False, max_states: int = 0, spill_dir: Optional[pathlib.Path] = None):
+    files = sorted(input.rglob('*.jsonl'))
+    if compact:
+        work = functools.partial(process_compact, input=input, samples_per_instance=samples_per_instance, seed=seed,
+                                 max_states=max_states, spill_dir=spill_dir)
+    else:
+        work = functools.partial(process, input=input, samples_per_instance=samples_per_instance, seed=seed)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor, open(output, 'w') as f:
+        # results come back in file order, so the output is the same for any number of workers
+        for lines in executor.map(work, files):
+            f.writelines(lines)
 
 
 if __name__ == '__main__':
@@ -95,6 +293,35 @@ if __name__ == '__main__':
         default=1000,
         help='The amount of samples per instance to extract',
     )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='The seed for sampling, the same seed and input give the same output',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='The amount of files to process in parallel',
+    )
+    parser.add_argument(
+        '--compact',
+        action=argparse.BooleanOptionalAction,
+        help='Keep only the stateId, depth, features and makespan of every state, to bound memory on huge instances',
+    )
+    parser.add_argument(
+        '--max-states',
+        type=int,
+        default=1_000_000,
+        help='(compact) The amount of distinct states per file to hold in memory before spilling them to disk',
+    )
+    parser.add_argument(
+        '--spill-dir',
+        type=pathlib.Path,
+        help='(compact) The folder to spill states to (default: the system temporary folder)',
+    )
     args = parser.parse_args()
 
     if not os.path.exists(args.input):
@@ -102,4 +329,5 @@ if __name__ == '__main__':
         exit(1)
     assert_empty(args.output, args.clean, 'file')
 
-    postprocess(args.input, args.output, args.samples)
+    postprocess(args.input, args.output, args.samples, args.seed, args.jobs, args.compact, args.max_states,
+                args.spill_dir)
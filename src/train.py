@@ -3,11 +3,16 @@ import json
 import pathlib
 import joblib
 
+from columnar_dataset import dataset_path, is_columnar, load_columnar
 from models import models, x_keys, y_key
 from utils import assert_empty
 
 
 def get_dataset(path: pathlib.Path):
+    if is_columnar(path):
+        dataset = load_columnar(path)
+        return dataset.X, dataset.y
+
     X = []
     y = []
     with open(path, 'r') as f:
@@ -42,7 +47,7 @@ if __name__ == '__main__':
         '--input',
         required=True,
         type=pathlib.Path,
-        help='The folder containing the train and test jsonl files',
+        help='The folder containing the train and test jsonl files (or their columnar datasets)',
     )
     parser.add_argument(
         '-o',
@@ -67,8 +72,8 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     output_model = args.output / f'{args.model}.joblib'
-    input_train = args.input / 'train.jsonl'
-    input_test = args.input / 'test.jsonl'
+    input_train = dataset_path(args.input, 'train')
+    input_test = dataset_path(args.input, 'test')
     if not input_train.exists():
         print(f"Input train file '{input_train}' does not exist")
         exit(1)
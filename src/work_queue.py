@@ -0,0 +1,191 @@
+"""
+A work queue in a shared directory, for ranks on one or several nodes (e.g. SLURM tasks) that only share a file system.
+
+    tasks/<id>.json         the task, added once (by whichever rank adds it first)
+    claims/<id>.<gen>       a lease on the task, created with O_EXCL so exactly one rank gets each generation
+    results/<id>.json       the result, written to a temporary file and renamed, so it is complete once it exists
+
+A rank holding a task touches its claim file while working on it. A claim whose mtime is older than the lease is
+expired: any rank may then take the task over by creating the claim of the next generation, which, again, only one
+rank can do. If the old holder was not dead after all, both finish the task and the later result replaces the earlier
+one, so tasks must be deterministic. Leases are compared against the file system's mtimes, so they have to be much
+longer than the clock skew between the nodes.
+"""
+import json
+import os
+import pathlib
+import random
+import socket
+import threading
+import time
+from typing import Dict, Optional
+
+DEFAULT_LEASE_SECONDS = 600
+POLL_SECONDS = 5
+
+
+def owner_name() -> str:
+    """Identifies this process in claim files"""
+    rank = os.environ.get('SLURM_PROCID')
+    return f"{socket.gethostname()}:{os.getpid()}" + (f":rank{rank}" if rank is not None else '')
+
+
+def write_atomic(path: pathlib.Path, data: bytes) -> None:
+    tmp = path.with_name(f'.{path.name}.{owner_name()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Claim:
+    def __init__(self, task_id: str, task: dict, path: pathlib.Path):
+        self.task_id = task_id
+        self.task = task
+        self.path = path
+
+
+class WorkQueue:
+    def __init__(self, path: pathlib.Path, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 owner: Optional[str] = None):
+        self.path = pathlib.Path(path)
+        self.lease_seconds = lease_seconds
+        self.owner = owner or owner_name()
+        self.tasks_dir = self.path / 'tasks'
+        self.claims_dir = self.path / 'claims'
+        self.results_dir = self.path / 'results'
+        for folder in (self.tasks_dir, self.claims_dir, self.results_dir):
+            os.makedirs(folder, exist_ok=True)
+
+    def add(self, task_id: str, task: dict) -> bool:
+        """Adds the task unless it already exists. Every rank can add all tasks, only the first one counts."""
+        path = self.tasks_dir / f'{task_id}.json'
+        if path.exists():
+            return False
+        tmp = path.with_name(f'.{path.name}.{owner_name()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(task, f)
+        try:
+            # a hard link fails if the task exists and is never seen half-written, unlike creating it in place
+            os.link(tmp, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+
+    def task_ids(self):
+        return [name[:-len('.json')] for name in os.listdir(self.tasks_dir) if name.endswith('.json')
+                and not name.startswith('.')]
+
+    def done_ids(self):
+        return {name[:-len('.json')] for name in os.listdir(self.results_dir) if name.endswith('.json')
+                and not name.startswith('.')}
+
+    def latest_claims(self) -> Dict[str, int]:
+        """The highest claim generation of every claimed task"""
+        claims = {}
+        for name in os.listdir(self.claims_dir):
+            task_id, _, generation = name.rpartition('.')
+            if generation.isdigit():
+                claims[task_id] = max(claims.get(task_id, -1), int(generation))
+        return claims
+
+    def claim(self) -> Optional[Claim]:
+        """Claims a task that nobody holds or whose lease expired, None if there is none right now"""
+        done = self.done_ids()
+        claims = self.latest_claims()
+        task_ids = sorted(self.task_ids())
+        # every rank walks the tasks in its own order, so they rarely race for the same claim
+        random.Random(self.owner).shuffle(task_ids)
+        for task_id in task_ids:
+            if task_id in done:
+                continue
+            generation = claims.get(task_id, -1)
+            if generation >= 0:
+                try:
+                    touched = os.stat(self.claims_dir / f'{task_id}.{generation}').st_mtime
+                except FileNotFoundError:
+                    continue
+                if touched + self.lease_seconds > time.time():
+                    continue
+            path = self.claims_dir / f'{task_id}.{generation + 1}'
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'owner': self.owner, 'claimed': time.time()}, f)
+            if (self.results_dir / f'{task_id}.json').exists():
+                # finished between listing the results and claiming it
+                continue
+            with open(self.tasks_dir / f'{task_id}.json', 'r') as f:
+                return Claim(task_id, json.load(f), path)
+        return None
+
+    def renew(self, claim: Claim) -> None:
+        try:
+            os.utime(claim.path)
+        except FileNotFoundError:
+            pass
+
+    def hold(self, claim: Claim) -> 'Heartbeat':
+        """Keeps renewing the lease in a background thread while the with block runs"""
+        return Heartbeat(self, claim)
+
+    def complete(self, claim: Claim, result: dict) -> None:
+        write_atomic(self.results_dir / f'{claim.task_id}.json', json.dumps(result).encode())
+
+    def result_path(self, task_id: str, suffix: str) -> pathlib.Path:
+        """Where a task can store extra result files, write them before completing the task"""
+        return self.results_dir / f'{task_id}{suffix}'
+
+    def results(self) -> Dict[str, dict]:
+        results = {}
+        for task_id in self.done_ids():
+            with open(self.results_dir / f'{task_id}.json', 'r') as f:
+                results[task_id] = json.load(f)
+        return results
+
+    def finished(self) -> bool:
+        return not set(self.task_ids()) - self.done_ids()
+
+    def wait(self) -> Optional[Claim]:
+        """
+        The next task to work on, waiting for the leases of other ranks to expire if they hold all remaining ones.
+        None once every task has a result.
+        """
+        while True:
+            claim = self.claim()
+            if claim is not None or self.finished():
+                return claim
+            time.sleep(min(POLL_SECONDS, self.lease_seconds))
+
+    def try_lock(self, name: str) -> bool:
+        """True for exactly one rank, e.g. to pick the one that reduces the results"""
+        try:
+            os.close(os.open(self.path / f'{name}.lock', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+
+class Heartbeat:
+    def __init__(self, queue: WorkQueue, claim: Claim):
+        self.queue = queue
+        self.claim = claim
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            self.queue.renew(self.claim)
+
+    def __enter__(self) -> Claim:
+        self.thread.start()
+        return self.claim
+
+    def __exit__(self, *exc) -> None:
+        self.stopped.set()
+        self.thread.join()